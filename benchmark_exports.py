@@ -0,0 +1,70 @@
+"""Сравнение форматов выгрузки на одном и том же наборе данных
+
+Запуск: python benchmark_exports.py [число_строк]
+
+Генерирует синтетические операции в формате выгрузки /export_* и для
+каждого формата из exports.py печатает время, пиковую память Python и
+размер файла. Время и память меряются отдельными прогонами: tracemalloc
+сильно замедляет код. База данных и токен бота не нужны.
+"""
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import exports
+
+
+def synthetic_transactions(count, seed=42):
+    """Строки в порядке exports.TRANSACTION_COLUMNS"""
+    rng = random.Random(seed)
+    users = [f"Пользователь {i}" for i in range(20)]
+    warehouses = [f"Склад {i}" for i in range(40)]
+    products = [f"Вино {i}" for i in range(300)]
+    start = datetime(2024, 1, 1)
+    for i in range(count):
+        yield (
+            start + timedelta(minutes=i),
+            rng.choice(users),
+            rng.choice(warehouses),
+            rng.choice(products),
+            rng.choice(['Приход', 'Расход']),
+            Decimal(rng.randint(1, 500)) / 2,
+            None if rng.random() < 0.9 else 'примечание',
+        )
+
+
+def run(fmt, count):
+    started = time.perf_counter()
+    output, written = exports.write_transactions(synthetic_transactions(count), fmt)
+    elapsed = time.perf_counter() - started
+    output.seek(0, 2)
+    size = output.tell()
+    output.close()
+
+    tracemalloc.start()
+    output, _ = exports.write_transactions(synthetic_transactions(count), fmt)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    output.close()
+    return written, elapsed, peak, size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    formats = [fmt for fmt in exports.FORMATS if fmt != 'parquet' or exports.PARQUET_AVAILABLE]
+
+    print(f"Строк: {count}")
+    print(f"{'формат':<10}{'время, с':>10}{'строк/с':>12}{'пик памяти, МБ':>17}{'файл, МБ':>11}")
+    for fmt in formats:
+        written, elapsed, peak, size = run(fmt, count)
+        print(f"{fmt:<10}{elapsed:>10.2f}{written / elapsed:>12.0f}"
+              f"{peak / 1024 / 1024:>17.1f}{size / 1024 / 1024:>11.2f}")
+    if not exports.PARQUET_AVAILABLE:
+        print("parquet пропущен: не установлен pyarrow")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,178 +1,1154 @@
 import os
 import sys
+import time
+import importlib
+
+# Время импорта тяжелых зависимостей меряем до остальных import'ов
+# (ниже они берутся уже готовыми из sys.modules) - для профиля запуска
+BOOT_STARTED = time.perf_counter()
+IMPORT_TIMINGS = {}
+for _module_name in ('requests', 'telebot', 'flask', 'pg8000'):
+    _started = time.perf_counter()
+    importlib.import_module(_module_name)
+    IMPORT_TIMINGS[_module_name] = time.perf_counter() - _started
+
 import telebot
 from datetime import datetime
-from flask import Flask, request
+from flask import Flask, Response, request, jsonify
 import pg8000
 from pg8000.native import Connection
 import json
-import time
-from telebot import types
-import pandas as pd
+import re
+import threading
+import queue
+import pickle
+import heapq
+import itertools
+from decimal import Decimal, InvalidOperation
+import sqlite3
+import random
+import atexit
+import logging
+import logging.handlers
+import bisect
+import functools
+from collections import deque
+from collections import OrderedDict, namedtuple
+from contextlib import closing, contextmanager
+from pg8000.core import IDLE
+from telebot import types, apihelper
+import requests
+from telebot.handler_backends import HandlerBackend
+import migrations
+from db_config import parse_db_url
+from stock_items import parse_spend_items
 from io import BytesIO
 from datetime import datetime, timedelta
 
-print("=" * 60, file=sys.stderr)
-print("🤖 WINE WAREHOUSE BOT WITH SUPABASE", file=sys.stderr)
-print(f"Python: {sys.version}", file=sys.stderr)
-print("=" * 60, file=sys.stderr)
+# ========== ЛОГИРОВАНИЕ ==========
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Какая доля частых отладочных событий (поиск пользователя, каждое
+# обновление) попадает в лог при LOG_LEVEL=DEBUG
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', 0.01))
+# Обработка обновления дольше этого порога пишется как предупреждение
+LOG_SLOW_UPDATE_MS = float(os.environ.get('LOG_SLOW_UPDATE_MS', 2000))
+
+log = logging.getLogger('wine_bot')
+
+# Поля текущего обновления (update_id, chat_id, handler) - свои у каждого потока
+log_context = threading.local()
+
+
+def kv(**fields):
+    """extra для записи лога с полями key=value: log.info("...", extra=kv(chat_id=1))"""
+    return {'fields': fields}
+
+
+def set_log_fields(**fields):
+    """Добавить поля к контексту текущего обновления"""
+    current = getattr(log_context, 'fields', None)
+    if current is None:
+        current = log_context.fields = {}
+    current.update(fields)
+
+
+class ContextFilter(logging.Filter):
+    """Переносит в запись поля контекста обновления
+
+    Фильтр стоит на QueueHandler и выполняется в потоке, который пишет в
+    лог, - поэтому видит его log_context.
+    """
+
+    def filter(self, record):
+        fields = dict(getattr(log_context, 'fields', None) or {})
+        fields.update(getattr(record, 'fields', None) or {})
+        record.fields = fields
+        return True
+
+
+def format_log_value(value):
+    text = str(value)
+    if not text or any(char in text for char in ' ="\n'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """время уровень сообщение key=value ..."""
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={format_log_value(value)}" for key, value in fields.items())
+        return line
+
+
+def setup_logging():
+    """Лог пишется в stderr из отдельного потока: вызывающий код только кладет
+    запись в очередь и не ждет записи в поток вывода"""
+    log_queue = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(log_queue)
+    handler.addFilter(ContextFilter())
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(KeyValueFormatter('%(asctime)s %(levelname)s %(message)s'))
+    listener = logging.handlers.QueueListener(log_queue, output)
+    
+    log.addHandler(handler)
+    log.setLevel(LOG_LEVEL)
+    log.propagate = False
+    listener.start()
+    # При выходе дописываем все, что осталось в очереди
+    atexit.register(listener.stop)
+
+
+def debug_sampled(event, **fields):
+    """Частое отладочное событие: пишется с вероятностью LOG_DEBUG_SAMPLE_RATE"""
+    if log.isEnabledFor(logging.DEBUG) and random.random() < LOG_DEBUG_SAMPLE_RATE:
+        log.debug(event, extra=kv(sample_rate=LOG_DEBUG_SAMPLE_RATE, **fields))
+
+
+setup_logging()
+log.info("🤖 WINE WAREHOUSE BOT WITH SUPABASE", extra=kv(python=sys.version.split()[0], log_level=LOG_LEVEL))
+
+# ========== МЕТРИКИ ==========
+# Метрики в формате Prometheus для /metrics. На горячем пути - только
+# инкремент счетчика под блокировкой; все остальное (очереди, пулы, кэши)
+# читается из их stats() в момент опроса, так что без опроса почти ничего
+# не стоит.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Счетчик с метками: requests.inc('balance', 'ok')"""
+
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            yield f"{self.name}{format_labels(self.labels, label_values)} {value}"
+
+
+class Histogram:
+    """Гистограмма длительностей с метками (секунды)"""
+
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # метки -> [счетчики по корзинам..., +Inf, сумма]
+        self._lock = threading.Lock()
+
+    def observe(self, seconds, *label_values):
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                values = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[index] += 1
+            values[-1] += seconds
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(label_values, list(counts)) for label_values, counts in self._values.items()]
+        labels = self.labels + ('le',)
+        for label_values, counts in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket{format_labels(labels, label_values + (bound,))} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labels, label_values)} {counts[-1]}"
+            yield f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}"
+
+
+class MetricsRegistry:
+    """Метрики процесса + функции, снимающие значения в момент опроса"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, func):
+        """Регистрирует func() -> [(имя, тип, справка, [(метки-словарь, значение)])]"""
+        self._collectors.append(func)
+        return func
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        for collect in self._collectors:
+            try:
+                families = collect()
+            except Exception as e:
+                log.warning("⚠️ Metrics collector failed", extra=kv(collector=collect.__name__, error=e))
+                continue
+            for name, metric_type, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    lines.append(f"{name}{format_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+HANDLER_REQUESTS = metrics.counter('bot_handler_requests_total', 'Обработанные обновления', ('handler', 'outcome'))
+HANDLER_DURATION = metrics.histogram('bot_handler_duration_seconds', 'Время обработки обновления', ('handler',))
+DB_QUERIES = metrics.counter('bot_db_queries_total', 'Запросы к БД', ('query', 'outcome'))
+DB_QUERY_DURATION = metrics.histogram('bot_db_query_duration_seconds', 'Время запроса к БД', ('query',))
+TELEGRAM_REQUESTS = metrics.counter('bot_telegram_api_requests_total', 'Запросы к Bot API', ('method', 'status'))
+TELEGRAM_DURATION = metrics.histogram('bot_telegram_api_duration_seconds', 'Время запроса к Bot API', ('method',))
+
+_QUERY_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+([A-Za-z_][A-Za-z_0-9]*)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def query_name(sql):
+    """Метка запроса: первое слово и первая таблица ("select_users", "with_stock")
+
+    SQL в боте статический, так что меток немного, а разбор кэшируется.
+    """
+    words = sql.split(None, 1)
+    verb = words[0].lower() if words else 'empty'
+    match = _QUERY_TABLE_RE.search(sql)
+    return f"{verb}_{match.group(1).lower()}" if match else verb
+
+# ========== ПРОФИЛЬ ЗАПУСКА ==========
+class StartupProfile:
+    """Замеры времени запуска по этапам и по импортам"""
+
+    def __init__(self, started, import_timings):
+        self.started = started
+        self.imports = dict(import_timings)
+        self.phases = []  # (этап, секунды)
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.phases.append((name, seconds))
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'phases_ms': {name: round(seconds * 1000, 1) for name, seconds in self.phases},
+                'imports_ms': {name: round(seconds * 1000, 1) for name, seconds in self.imports.items()},
+            }
+
+    def report(self):
+        with self._lock:
+            lines = [f"⏱️ Startup profile ({time.perf_counter() - self.started:.2f} s since start):"]
+            for name, seconds in self.phases:
+                lines.append(f"   {name}: {seconds * 1000:.0f} ms")
+            lines.append("   imports:")
+            for name, seconds in sorted(self.imports.items(), key=lambda item: -item[1]):
+                lines.append(f"     {name}: {seconds * 1000:.0f} ms")
+            return '\n'.join(lines)
+
+
+startup = StartupProfile(BOOT_STARTED, IMPORT_TIMINGS)
+
+
+class LazyModule:
+    """Модуль, который импортируется при первом обращении к его атрибутам
+
+    Выгрузки (openpyxl, pyarrow) нужны только админам и редко - не платим
+    за их импорт при каждом холодном старте.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                started = time.perf_counter()
+                self._module = importlib.import_module(self._name)
+                elapsed = time.perf_counter() - started
+                startup.add(f"lazy import {self._name}", elapsed)
+                log.info(f"📦 Loaded {self._name} on first use in {elapsed * 1000:.0f} ms")
+            return self._module
+
+    def __getattr__(self, attr):
+        module = self._module or self._load()
+        return getattr(module, attr)
+
+
+exports = LazyModule('exports')
+stock_import = LazyModule('stock_import')
 
 # Получаем настройки
 TOKEN = os.environ['TELEGRAM_TOKEN']
 ADMIN_IDS = [int(x) for x in os.environ['ADMIN_IDS'].split(',')]
 DATABASE_URL = os.environ['SUPABASE_DB_URL']
 
-bot = telebot.TeleBot(TOKEN)
+# threaded=False: обработчики выполняются в наших рабочих потоках
+# (см. UpdateDispatcher), а не во внутреннем пуле telebot
+bot = telebot.TeleBot(TOKEN, threaded=False)
 app = Flask(__name__)
 
-# ========== БАЗА ДАННЫХ ==========
-def parse_db_url(url):
-    """Разбираем URL подключения"""
-    url = url.replace('postgresql://', '')
-    
-    if '@' in url:
-        auth, rest = url.split('@', 1)
-        user, password = auth.split(':', 1)
-    else:
-        user, password = 'postgres', ''
-        rest = url
-    
-    if ':' in rest:
-        host_port, database = rest.split('/', 1)
-        if ':' in host_port:
-            host, port = host_port.split(':', 1)
-            port = int(port)
-        else:
-            host, port = host_port, 5432
-    else:
-        host, port = rest, 5432
-        database = 'postgres'
-    
-    database = database.split('?')[0]
-    
-    return {
-        'user': user,
-        'password': password,
-        'host': host,
-        'port': port,
-        'database': database
-    }
+# ========== ПУЛ ПОДКЛЮЧЕНИЙ ==========
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 5))
+DB_POOL_IDLE_TIMEOUT = float(os.environ.get('DB_POOL_IDLE_TIMEOUT', 300))
+DB_POOL_CHECKOUT_TIMEOUT = float(os.environ.get('DB_POOL_CHECKOUT_TIMEOUT', 10))
+DB_POOL_HEALTH_CHECK_AFTER = float(os.environ.get('DB_POOL_HEALTH_CHECK_AFTER', 30))
+
+
+class PoolTimeout(Exception):
+    """Все подключения заняты и ни одно не освободилось за отведенное время"""
+
+
+class PooledConnection:
+    """Подключение из пула: close() возвращает его в пул, а не закрывает"""
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self.raw = raw
+        self.last_used = time.monotonic()
+        self.broken = False
+        self.checked_out = False
+
+    def run(self, sql, **params):
+        name = query_name(sql)
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = self.raw.run(sql, **params)
+            outcome = 'ok'
+            return result
+        except pg8000.exceptions.InterfaceError:
+            # Сетевая ошибка - такое подключение в пул не возвращаем
+            self.broken = True
+            raise
+        finally:
+            DB_QUERY_DURATION.observe(time.perf_counter() - started, name)
+            DB_QUERIES.inc(name, outcome)
+
+    def close(self):
+        if self.checked_out:
+            self._pool.release(self)
+
+
+class ConnectionPool:
+    """Ограниченный потокобезопасный пул подключений pg8000"""
+
+    def __init__(self, connect, min_size=1, max_size=5, idle_timeout=300,
+                 checkout_timeout=10, health_check_after=30):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.health_check_after = health_check_after
+        self._idle = []  # стек: последним вернули - первым выдаем
+        self._size = 0   # открыто всего (свободные + выданные)
+        self._cond = threading.Condition()
+        self._reaper = None
+        self._counters = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'reused': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'health_check_failures': 0,
+            'connect_errors': 0,
+        }
+        self._wait_time_total = 0.0
+
+    def acquire(self, timeout=None):
+        """Выдать подключение (ждем освобождения, если пул заполнен)"""
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        started = time.monotonic()
+        waited = False
+
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._idle:
+                        conn = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['timeouts'] += 1
+                        raise PoolTimeout(f"нет свободных подключений за {timeout} с.")
+                    if not waited:
+                        waited = True
+                        self._counters['waits'] += 1
+                    self._cond.wait(remaining)
+
+            reused = conn is not None
+            if conn is None:
+                conn = self._open()
+            elif not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._counters['checkouts'] += 1
+                self._counters['reused'] += reused
+                self._wait_time_total += time.monotonic() - started
+            conn.checked_out = True
+            return conn
+
+    def release(self, conn):
+        """Вернуть подключение в пул"""
+        conn.checked_out = False
+        if not conn.broken and getattr(conn.raw, '_transaction_status', IDLE) != IDLE:
+            # Незавершенная транзакция не должна достаться следующему
+            try:
+                conn.raw.run("ROLLBACK")
+            except Exception:
+                conn.broken = True
+        if conn.broken:
+            self._discard(conn)
+            return
+        conn.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """with db_pool.connection() as conn: ..."""
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def warm(self):
+        """Заранее открыть min_size подключений"""
+        opened = []
+        try:
+            while len(opened) < self.min_size:
+                opened.append(self.acquire())
+        finally:
+            for conn in opened:
+                conn.close()
+
+    def prune(self):
+        """Закрыть подключения, простаивающие дольше idle_timeout (сверх min_size)"""
+        now = time.monotonic()
+        expired = []
+        with self._cond:
+            keep = []
+            # Самые старые лежат в начале стека
+            for conn in self._idle:
+                idle_for = now - conn.last_used
+                if idle_for > self.idle_timeout and self._size - len(expired) > self.min_size:
+                    expired.append(conn)
+                else:
+                    keep.append(conn)
+            self._idle = keep
+        for conn in expired:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            in_use = self._size - len(self._idle)
+            checkouts = self._counters['checkouts']
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': in_use,
+                'avg_wait_ms': round(self._wait_time_total / checkouts * 1000, 2) if checkouts else 0.0,
+                **self._counters,
+            }
+
+    def _open(self):
+        try:
+            raw = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._counters['connect_errors'] += 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._counters['created'] += 1
+        self._start_reaper()
+        return PooledConnection(self, raw)
+
+    def _is_healthy(self, conn):
+        # Проверяем только давно простаивавшие подключения, чтобы не платить
+        # лишним запросом за каждую выдачу
+        if time.monotonic() - conn.last_used < self.health_check_after:
+            return True
+        try:
+            conn.raw.run("SELECT 1")
+            return True
+        except Exception:
+            with self._cond:
+                self._counters['health_check_failures'] += 1
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._counters['closed'] += 1
+            self._cond.notify()
+
+    def _start_reaper(self):
+        if self._reaper is not None or self.idle_timeout <= 0:
+            return
+        with self._cond:
+            if self._reaper is not None:
+                return
+            self._reaper = threading.Thread(target=self._reap_forever, name='db-pool-reaper', daemon=True)
+            self._reaper.start()
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 2, 1))
+            try:
+                self.prune()
+            except Exception as e:
+                log.warning(f"⚠️ DB pool prune error: {e}")
+
+
+DB_PARAMS = parse_db_url(DATABASE_URL)
+
+db_pool = ConnectionPool(
+    lambda: Connection(**DB_PARAMS),
+    min_size=DB_POOL_MIN_SIZE,
+    max_size=DB_POOL_MAX_SIZE,
+    idle_timeout=DB_POOL_IDLE_TIMEOUT,
+    checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT,
+    health_check_after=DB_POOL_HEALTH_CHECK_AFTER,
+)
+
 
 def get_db_connection():
-    """Создаем подключение к БД"""
+    """Берем подключение из пула (conn.close() вернет его обратно)"""
     try:
-        params = parse_db_url(DATABASE_URL)
-        conn = Connection(**params)
-        return conn
+        return db_pool.acquire()
     except Exception as e:
-        print(f"❌ DB connection error: {e}", file=sys.stderr)
+        log.error(f"❌ DB connection error: {e}")
         return None
 
+# ========== МИГРАЦИИ ==========
+# Схема и индексы описаны в migrations.py; вручную: python migrations.py migrate
+DB_MIGRATE_ON_START = os.environ.get('DB_MIGRATE_ON_START', '1') == '1'
+
+
+# Рабочие потоки UpdateDispatcher не берут обновления, пока миграции не
+# закончатся: иначе при первом запуске новой версии списания и приходы
+# падали бы на еще не созданных колонках и таблицах
+schema_ready = threading.Event()
+if not DB_MIGRATE_ON_START:
+    schema_ready.set()
+
+
+def apply_migrations():
+    """Применить недостающие миграции схемы и открыть обработку обновлений"""
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return
+        try:
+            migrations.migrate(conn, log=log.info)
+        except Exception as e:
+            log.error(f"❌ Migration error: {e}")
+        finally:
+            conn.close()
+    finally:
+        # Даже после ошибки: ждать дальше бессмысленно, а без БД бот хотя бы ответит
+        schema_ready.set()
+
+# ========== КЭШ ==========
+class TTLCache:
+    """Потокобезопасный LRU-кэш с ограниченным временем жизни записей"""
+
+    MISSING = object()
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Значение из кэша или TTLCache.MISSING"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return self.MISSING
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else 0.0,
+            }
+
 # ========== ПОЛЬЗОВАТЕЛИ ==========
-def get_user_by_telegram_id(telegram_id):
-    """Получить пользователя по telegram_id - ДОБАВИМ ОТЛАДКУ"""
-    print(f"DEBUG: Searching user with telegram_id={telegram_id}", file=sys.stderr)
-    
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+USER_CACHE_NEGATIVE_TTL = float(os.environ.get('USER_CACHE_NEGATIVE_TTL', 60))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 1000))
+
+# telegram_id -> пользователь; None означает "такого пользователя нет"
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+def load_user_by_telegram_id(telegram_id):
+    """Прочитать пользователя из БД в обход кэша (ошибки БД пробрасываются)"""
     conn = get_db_connection()
     if not conn:
-        print(f"DEBUG: No DB connection", file=sys.stderr)
-        return None
+        raise ConnectionError("нет подключения к БД")
     
     try:
         result = conn.run("""
-            SELECT u.*, w.name as warehouse_name 
+            SELECT u.id, u.telegram_id, u.username, u.full_name, u.role,
+                   u.warehouse_id, w.name as warehouse_name 
             FROM users u
             LEFT JOIN warehouses w ON u.warehouse_id = w.id
             WHERE u.telegram_id = :telegram_id
         """, telegram_id=telegram_id)
         
-        print(f"DEBUG: Query result: {result}", file=sys.stderr)
-        
-        if result:
-            user = {
-                'id': result[0][0],
-                'telegram_id': result[0][1],
-                'username': result[0][2],
-                'full_name': result[0][3],
-                'role': result[0][4],
-                'warehouse_id': result[0][6],
-                'warehouse_name': result[0][7]
-            }
-            print(f"DEBUG: Found user: {user['full_name']}", file=sys.stderr)
-            return user
-        
-        print(f"DEBUG: User not found", file=sys.stderr)
-        return None
+        if not result:
+            return None
+        
+        row = result[0]
+        return {
+            'id': row[0],
+            'telegram_id': row[1],
+            'username': row[2],
+            'full_name': row[3],
+            'role': row[4],
+            'warehouse_id': row[5],
+            'warehouse_name': row[6]
+        }
+    finally:
+        conn.close()
+
+
+def get_user_by_telegram_id(telegram_id):
+    """Получить пользователя по telegram_id (через кэш)"""
+    user = user_cache.get(telegram_id)
+    if user is not TTLCache.MISSING:
+        return user
+    
+    started = time.perf_counter()
+    try:
+        user = load_user_by_telegram_id(telegram_id)
     except Exception as e:
-        print(f"DEBUG: Error: {e}", file=sys.stderr)
+        # Ошибку БД не кэшируем - следующий запрос попробует снова
+        log.warning("❌ User lookup failed", extra=kv(telegram_id=telegram_id, error=e))
         return None
-    finally:
+    
+    if user:
+        user_cache.set(telegram_id, user)
+    else:
+        # Отрицательный кэш: спам от незарегистрированных не доходит до БД
+        user_cache.set(telegram_id, None, ttl=USER_CACHE_NEGATIVE_TTL)
+    debug_sampled("user loaded", telegram_id=telegram_id, found=user is not None,
+                  duration_ms=round((time.perf_counter() - started) * 1000, 1))
+    return user
+
+
+# Растет при каждом изменении пользователей: ФИО попадают в выгрузки,
+# поэтому версия входит в ключ кэша выгрузок
+users_version = 0
+
+
+def invalidate_user(telegram_id):
+    """Сбросить кэш пользователя после изменения его записи"""
+    global users_version
+    users_version += 1
+    user_cache.invalidate(telegram_id)
+
+# ========== КОНТЕКСТ ОБНОВЛЕНИЯ ==========
+class UpdateContext:
+    """Данные одного обновления Telegram: пользователь загружается не больше одного раза"""
+
+    _NOT_LOADED = object()
+
+    def __init__(self, telegram_id):
+        self.telegram_id = telegram_id
+        self._user = self._NOT_LOADED
+
+    @property
+    def user(self):
+        if self._user is self._NOT_LOADED:
+            self._user = get_user_by_telegram_id(self.telegram_id)
+        return self._user
+
+
+def update_context(message):
+    """Контекст обновления, к которому относится сообщение
+
+    Хранится прямо в объекте сообщения, поэтому все обработчики, которым
+    передается это сообщение (кнопка -> команда -> функции БД), видят одного
+    и того же пользователя без повторных запросов.
+    """
+    ctx = getattr(message, '_update_context', None)
+    if ctx is None:
+        ctx = UpdateContext(message.from_user.id)
+        message._update_context = ctx
+    return ctx
+
+
+def current_user(message):
+    """Пользователь, отправивший сообщение (или None, если не зарегистрирован)"""
+    return update_context(message).user
+
+# ========== СОСТОЯНИЕ ДИАЛОГОВ ==========
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_DB_PATH = os.environ.get('STATE_DB_PATH', 'conversation_state.sqlite3')
+STATE_TTL = float(os.environ.get('STATE_TTL', 900))
+STATE_MAX_ENTRIES = int(os.environ.get('STATE_MAX_ENTRIES', 10000))
+STATE_PURGE_INTERVAL = 60
+
+
+def parse_step_ttls(value):
+    """"process_add_user_name=1800,process_add_product=300" -> {шаг: секунды}"""
+    ttls = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        name, _, seconds = item.partition('=')
+        ttls[name.strip()] = float(seconds)
+    return ttls
+
+
+# Время жизни отдельных шагов диалога (по имени функции-обработчика)
+STATE_STEP_TTLS = parse_step_ttls(os.environ.get('STATE_STEP_TTLS', ''))
+
+
+class MemoryStateStore:
+    """Состояния диалогов в памяти процесса"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()  # chat_id -> (expires_at, handlers)
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self.expired = 0
+
+    def get(self, chat_id):
+        with self._lock:
+            entry = self._data.get(chat_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._data[chat_id]
+                self.expired += 1
+                return None
+            return entry[1]
+
+    def put(self, chat_id, handlers, expires_at):
+        with self._lock:
+            self._data[chat_id] = (expires_at, handlers)
+            self._data.move_to_end(chat_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evicted += 1
+
+    def pop(self, chat_id):
+        handlers = self.get(chat_id)
+        self.delete(chat_id)
+        return handlers
+
+    def delete(self, chat_id):
+        with self._lock:
+            self._data.pop(chat_id, None)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            stale = [chat_id for chat_id, (expires_at, _) in self._data.items() if expires_at <= now]
+            for chat_id in stale:
+                del self._data[chat_id]
+            self.expired += len(stale)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': 'memory',
+                'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'expired': self.expired,
+                'evicted': self.evicted,
+            }
+
+
+class SQLiteStateStore:
+    """Состояния диалогов в файле SQLite - общие для нескольких процессов и
+    переживают перезапуск"""
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self.expired = 0
+        self.evicted = 0
+        self.unreadable = 0
+        with self._connect() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS conversation_state (
+                    chat_id INTEGER PRIMARY KEY,
+                    handlers BLOB NOT NULL,
+                    expires_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            db.execute("CREATE INDEX IF NOT EXISTS conversation_state_expires ON conversation_state (expires_at)")
+            db.execute("CREATE INDEX IF NOT EXISTS conversation_state_updated ON conversation_state (updated_at)")
+
+    def _connect(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute("PRAGMA journal_mode=WAL")
+            self._local.db = db
+        return db
+
+    def get(self, chat_id):
+        db = self._connect()
+        row = db.execute("SELECT handlers, expires_at FROM conversation_state WHERE chat_id = ?",
+                         (chat_id,)).fetchone()
+        if row is None:
+            return None
+        if row[1] <= time.time():
+            self.delete(chat_id)
+            self.expired += 1
+            return None
         try:
-            conn.close()
-        except:
-            pass
+            return pickle.loads(row[0])
+        except Exception as e:
+            # Шаг диалога из прошлой версии бота (функцию переименовали или
+            # удалили) - сбрасываем его, иначе чат застрянет до истечения STATE_TTL
+            log.warning("⚠️ Dropped unreadable conversation state", extra=kv(chat_id=chat_id, error=e))
+            self.delete(chat_id)
+            self.unreadable += 1
+            return None
+
+    def put(self, chat_id, handlers, expires_at):
+        with self._connect() as db:
+            db.execute("""
+                INSERT INTO conversation_state (chat_id, handlers, expires_at, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    handlers = excluded.handlers,
+                    expires_at = excluded.expires_at,
+                    updated_at = excluded.updated_at
+            """, (chat_id, pickle.dumps(handlers), expires_at, time.time()))
+            cursor = db.execute("""
+                DELETE FROM conversation_state WHERE chat_id IN (
+                    SELECT chat_id FROM conversation_state
+                    ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            self.evicted += max(cursor.rowcount, 0)
+
+    def pop(self, chat_id):
+        handlers = self.get(chat_id)
+        if handlers is not None:
+            self.delete(chat_id)
+        return handlers
+
+    def delete(self, chat_id):
+        with self._connect() as db:
+            db.execute("DELETE FROM conversation_state WHERE chat_id = ?", (chat_id,))
+
+    def purge_expired(self):
+        with self._connect() as db:
+            cursor = db.execute("DELETE FROM conversation_state WHERE expires_at <= ?", (time.time(),))
+            self.expired += max(cursor.rowcount, 0)
+
+    def stats(self):
+        entries = self._connect().execute("SELECT COUNT(*) FROM conversation_state").fetchone()[0]
+        return {
+            'backend': 'sqlite',
+            'path': self.path,
+            'entries': entries,
+            'max_entries': self.max_entries,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'unreadable': self.unreadable,
+        }
+
+
+class ConversationStateBackend(HandlerBackend):
+    """Хранилище next-step обработчиков telebot поверх MemoryStateStore/SQLiteStateStore
+
+    Каждому ожидающему шагу назначается срок жизни (STATE_TTL или значение из
+    STATE_STEP_TTLS), брошенные диалоги удаляются, а число записей ограничено.
+    """
+
+    def __init__(self, store, default_ttl=900, step_ttls=None):
+        super().__init__()
+        self.store = store
+        self.default_ttl = default_ttl
+        self.step_ttls = step_ttls or {}
+        self._last_purge = time.monotonic()
+
+    def _ttl_for(self, handler):
+        name = getattr(handler['callback'], '__name__', '')
+        return self.step_ttls.get(name, self.default_ttl)
+
+    def register_handler(self, handler_group_id, handler):
+        handlers = self.store.get(handler_group_id) or []
+        handlers.append(handler)
+        expires_at = time.time() + min(self._ttl_for(h) for h in handlers)
+        self.store.put(handler_group_id, handlers, expires_at)
+        self._maybe_purge()
+
+    def clear_handlers(self, handler_group_id):
+        self.store.delete(handler_group_id)
+
+    def get_handlers(self, handler_group_id):
+        return self.store.pop(handler_group_id)
+
+    def _maybe_purge(self):
+        if time.monotonic() - self._last_purge < STATE_PURGE_INTERVAL:
+            return
+        self._last_purge = time.monotonic()
+        try:
+            self.store.purge_expired()
+        except Exception as e:
+            log.warning(f"⚠️ State purge error: {e}")
+
+
+def make_state_store():
+    """Хранилище состояний диалогов по настройке STATE_BACKEND"""
+    if STATE_BACKEND == 'sqlite':
+        return SQLiteStateStore(STATE_DB_PATH, max_entries=STATE_MAX_ENTRIES)
+    if STATE_BACKEND != 'memory':
+        log.warning(f"⚠️ Unknown STATE_BACKEND={STATE_BACKEND}, using memory")
+    return MemoryStateStore(max_entries=STATE_MAX_ENTRIES)
+
+
+bot.next_step_backend = ConversationStateBackend(make_state_store(), default_ttl=STATE_TTL,
+                                                 step_ttls=STATE_STEP_TTLS)
+
+# ========== СПРАВОЧНИКИ ТОВАРОВ И СКЛАДОВ ==========
+class Catalog:
+    """Кэш справочников товаров и складов
+
+    Перечитывается из БД только когда version изменилась, т.е. после
+    invalidate() (добавление/удаление товара или склада) или /refresh_catalog.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = 0
+        self._loaded_version = None
+        self.products = []
+        self.warehouses = []
+        self.product_names = {}     # id -> название
+        self.product_ids = {}       # название в нижнем регистре -> id
+        self.warehouse_names = {}
+        self.warehouse_ids = {}
+        self.loaded_at = None
+        self.reloads = 0
+
+    def invalidate(self):
+        """Отметить справочники устаревшими (после изменения таблиц)"""
+        with self._lock:
+            self.version += 1
+
+    def ensure_fresh(self):
+        """Перечитать справочники, если они устарели. False - если БД недоступна"""
+        with self._lock:
+            if self._loaded_version == self.version:
+                return True
+            version = self.version
+            
+            conn = get_db_connection()
+            if not conn:
+                return False
+            try:
+                products = conn.run("SELECT id, name FROM products ORDER BY name")
+                warehouses = conn.run("SELECT id, name FROM warehouses ORDER BY name")
+            except Exception as e:
+                # Оставляем старые данные - лучше устаревший список, чем пустой
+                log.error(f"❌ Error loading catalog: {e}")
+                return False
+            finally:
+                conn.close()
+            
+            self.products = [{'id': row[0], 'name': row[1]} for row in products]
+            self.warehouses = [{'id': row[0], 'name': row[1]} for row in warehouses]
+            self.product_names = {p['id']: p['name'] for p in self.products}
+            self.product_ids = {p['name'].lower(): p['id'] for p in self.products}
+            self.warehouse_names = {w['id']: w['name'] for w in self.warehouses}
+            self.warehouse_ids = {w['name'].lower(): w['id'] for w in self.warehouses}
+            self._loaded_version = version
+            self.loaded_at = datetime.now()
+            self.reloads += 1
+            return True
+
+    def refresh(self):
+        """Принудительно перечитать справочники"""
+        self.invalidate()
+        return self.ensure_fresh()
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'loaded_version': self._loaded_version,
+            'products': len(self.products),
+            'warehouses': len(self.warehouses),
+            'reloads': self.reloads,
+            'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+        }
+
+
+catalog = Catalog()
+
 # ========== СКЛАДЫ ==========
 def get_all_warehouses():
     """Получить все склады (для админа)"""
-    conn = get_db_connection()
-    if not conn:
-        return []
-    
-    try:
-        result = conn.run("SELECT id, name FROM warehouses ORDER BY name")
-        return [{'id': row[0], 'name': row[1]} for row in result]
-    except Exception as e:
-        print(f"❌ Error getting warehouses: {e}", file=sys.stderr)
-        return []
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
+    catalog.ensure_fresh()
+    return list(catalog.warehouses)
 
 # ========== ТОВАРЫ ==========
 def get_all_products():
     """Получить все товары"""
-    conn = get_db_connection()
-    if not conn:
-        return []
-    
-    try:
-        result = conn.run("SELECT id, name FROM products ORDER BY name")
-        return [{'id': row[0], 'name': row[1]} for row in result]
-    except Exception as e:
-        print(f"❌ Error getting products: {e}", file=sys.stderr)
-        return []
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
+    catalog.ensure_fresh()
+    return list(catalog.products)
 
 # ========== ОСТАТКИ ==========
 
-def get_user_balance(telegram_id, warehouse_id=None):
+def get_user_balance(user, warehouse_id=None):
     """Получить остатки пользователя (только его склад)"""
+    if not user:
+        return []
+    
     conn = get_db_connection()
     if not conn:
         return []
     
     try:
-        user = get_user_by_telegram_id(telegram_id)
-        if not user:
-            return []
-        
         # Определяем склад (если не указан явно - берем склад пользователя)
         target_warehouse = warehouse_id or user['warehouse_id']
         if not target_warehouse:
             return []
         
-        # Получаем остатки из таблицы stock (только для этого склада)
+        # Получаем остатки из таблицы stock (только для этого склада).
+        # stock разреженная: нет строки - значит остаток нулевой
         result = conn.run("""
-            SELECT p.name, COALESCE(s.quantity, 0) as quantity
-            FROM products p
-            LEFT JOIN stock s ON p.id = s.product_id AND s.warehouse_id = :warehouse_id
-            WHERE COALESCE(s.quantity, 0) > 0
+            SELECT p.name, s.quantity
+            FROM stock s
+            JOIN products p ON p.id = s.product_id
+            WHERE s.warehouse_id = :warehouse_id AND s.quantity > 0
             ORDER BY p.name
         """, warehouse_id=target_warehouse)
         
@@ -185,7 +1161,7 @@ def get_user_balance(telegram_id, warehouse_id=None):
         return balances
             
     except Exception as e:
-        print(f"❌ Error getting balance: {e}", file=sys.stderr)
+        log.error(f"❌ Error getting balance: {e}")
         return []
     finally:
         try:
@@ -194,124 +1170,352 @@ def get_user_balance(telegram_id, warehouse_id=None):
             pass
 
 # ========== ОПЕРАЦИИ ==========
-def add_transaction(telegram_id, product_id, quantity, transaction_type, warehouse_id=None):
-    """Добавить операцию (списание/пополнение) - НОВАЯ ВЕРСИЯ без user_id в stock"""
+# Приход: увеличиваем остаток (или создаем строку) и пишем журнал одним запросом
+STOCK_IN_SQL = """
+    WITH moved AS (
+        INSERT INTO stock (warehouse_id, product_id, quantity)
+        VALUES (:warehouse_id, :product_id, :quantity)
+        ON CONFLICT (warehouse_id, product_id)
+        DO UPDATE SET quantity = stock.quantity + EXCLUDED.quantity,
+                      updated_at = NOW()
+        RETURNING quantity
+    ), logged AS (
+        INSERT INTO transactions (product_id, warehouse_id, user_id, type, quantity)
+        SELECT :product_id, :warehouse_id, :user_id, 'in', :quantity FROM moved
+    ), rolled AS (
+        INSERT INTO transaction_daily_rollup (day, warehouse_id, product_id, type, quantity, operations)
+        SELECT CURRENT_DATE, :warehouse_id, :product_id, 'in', :quantity, 1 FROM moved
+        ON CONFLICT (day, warehouse_id, product_id, type)
+        DO UPDATE SET quantity = transaction_daily_rollup.quantity + EXCLUDED.quantity,
+                      operations = transaction_daily_rollup.operations + 1
+    )
+    SELECT quantity FROM moved
+"""
+
+# Списание: проверка остатка и уменьшение - одно условное UPDATE. Строка
+# блокируется, и параллельное списание перепроверит условие после нашего,
+# поэтому остаток не может уйти в минус. Журнал пишется только если
+# UPDATE что-то изменил (как и дневная сводка).
+STOCK_OUT_SQL = """
+    WITH moved AS (
+        UPDATE stock
+        SET quantity = quantity - :quantity,
+            updated_at = NOW()
+        WHERE warehouse_id = :warehouse_id
+          AND product_id = :product_id
+          AND quantity >= :quantity
+        RETURNING quantity
+    ), logged AS (
+        INSERT INTO transactions (product_id, warehouse_id, user_id, type, quantity)
+        SELECT :product_id, :warehouse_id, :user_id, 'out', :quantity FROM moved
+    ), rolled AS (
+        INSERT INTO transaction_daily_rollup (day, warehouse_id, product_id, type, quantity, operations)
+        SELECT CURRENT_DATE, :warehouse_id, :product_id, 'out', :quantity, 1 FROM moved
+        ON CONFLICT (day, warehouse_id, product_id, type)
+        DO UPDATE SET quantity = transaction_daily_rollup.quantity + EXCLUDED.quantity,
+                      operations = transaction_daily_rollup.operations + 1
+    )
+    SELECT quantity FROM moved
+"""
+
+
+def move_stock(conn, warehouse_id, product_id, quantity, transaction_type, user_id=None):
+    """Атомарно изменить остаток и записать операцию в журнал
+
+    user_id - кто выполнил операцию (users.id).
+    Возвращает новый остаток или None, если для списания не хватило товара.
+    """
+    if transaction_type == 'in':
+        sql = STOCK_IN_SQL
+    elif transaction_type == 'out':
+        sql = STOCK_OUT_SQL
+    else:
+        raise ValueError(f"Неизвестный тип операции: {transaction_type}")
+    
+    result = conn.run(sql, warehouse_id=warehouse_id, product_id=product_id, quantity=quantity,
+                      user_id=user_id)
+    return result[0][0] if result else None
+
+
+# Пакетное пополнение: все строки передаются массивами и применяются одним
+# запросом (одна транзакция, один круг до БД на весь файл). Повторы пары
+# склад+товар суммируются для stock и сводки, а в журнал идет каждая строка.
+STOCK_IN_BATCH_SQL = """
+    WITH input AS (
+        SELECT *
+        FROM unnest(CAST(:warehouse_ids AS INTEGER[]),
+                    CAST(:product_ids AS INTEGER[]),
+                    CAST(:quantities AS NUMERIC[])) AS m(warehouse_id, product_id, quantity)
+    ), totals AS (
+        SELECT warehouse_id, product_id, SUM(quantity) AS quantity, COUNT(*) AS operations
+        FROM input
+        GROUP BY warehouse_id, product_id
+    ), moved AS (
+        INSERT INTO stock (warehouse_id, product_id, quantity)
+        SELECT warehouse_id, product_id, quantity FROM totals
+        ON CONFLICT (warehouse_id, product_id)
+        DO UPDATE SET quantity = stock.quantity + EXCLUDED.quantity,
+                      updated_at = NOW()
+        RETURNING warehouse_id, product_id, quantity
+    ), logged AS (
+        INSERT INTO transactions (product_id, warehouse_id, user_id, type, quantity)
+        SELECT product_id, warehouse_id, :user_id, 'in', quantity FROM input
+    ), rolled AS (
+        INSERT INTO transaction_daily_rollup (day, warehouse_id, product_id, type, quantity, operations)
+        SELECT CURRENT_DATE, warehouse_id, product_id, 'in', quantity, operations FROM totals
+        ON CONFLICT (day, warehouse_id, product_id, type)
+        DO UPDATE SET quantity = transaction_daily_rollup.quantity + EXCLUDED.quantity,
+                      operations = transaction_daily_rollup.operations + EXCLUDED.operations
+    )
+    SELECT warehouse_id, product_id, quantity FROM moved
+"""
+
+
+def receive_stock_batch(conn, movements, user_id=None):
+    """Пополнить остатки пачкой [(склад, товар, количество)] одним запросом
+
+    Возвращает новые остатки [(склад, товар, остаток)].
+    """
+    if not movements:
+        return []
+    warehouse_ids, product_ids, quantities = (list(column) for column in zip(*movements))
+    return conn.run(STOCK_IN_BATCH_SQL, warehouse_ids=warehouse_ids, product_ids=product_ids,
+                    quantities=quantities, user_id=user_id)
+
+
+# Пакетное списание с одного склада. Повторы товара суммируются; товар,
+# которого не хватает на всю сумму, не списывается вовсе. Финальный SELECT
+# читает stock до изменений (снимок запроса) - это доступный остаток.
+STOCK_OUT_BATCH_SQL = """
+    WITH input AS (
+        SELECT *
+        FROM unnest(CAST(:product_ids AS INTEGER[]),
+                    CAST(:quantities AS NUMERIC[])) AS m(product_id, quantity)
+    ), totals AS (
+        SELECT product_id, SUM(quantity) AS quantity, COUNT(*) AS operations
+        FROM input
+        GROUP BY product_id
+    ), moved AS (
+        UPDATE stock s
+        SET quantity = s.quantity - t.quantity,
+            updated_at = NOW()
+        FROM totals t
+        WHERE s.warehouse_id = :warehouse_id
+          AND s.product_id = t.product_id
+          AND s.quantity >= t.quantity
+        RETURNING s.product_id, s.quantity
+    ), logged AS (
+        INSERT INTO transactions (product_id, warehouse_id, user_id, type, quantity)
+        SELECT i.product_id, :warehouse_id, :user_id, 'out', i.quantity
+        FROM input i JOIN moved m ON m.product_id = i.product_id
+    ), rolled AS (
+        INSERT INTO transaction_daily_rollup (day, warehouse_id, product_id, type, quantity, operations)
+        SELECT CURRENT_DATE, :warehouse_id, t.product_id, 'out', t.quantity, t.operations
+        FROM totals t JOIN moved m ON m.product_id = t.product_id
+        ON CONFLICT (day, warehouse_id, product_id, type)
+        DO UPDATE SET quantity = transaction_daily_rollup.quantity + EXCLUDED.quantity,
+                      operations = transaction_daily_rollup.operations + EXCLUDED.operations
+    )
+    SELECT t.product_id, t.quantity, m.quantity, COALESCE(s.quantity, 0)
+    FROM totals t
+    LEFT JOIN moved m ON m.product_id = t.product_id
+    LEFT JOIN stock s ON s.warehouse_id = :warehouse_id AND s.product_id = t.product_id
+"""
+
+
+def spend_stock_batch(conn, warehouse_id, items, user_id=None):
+    """Списать пачку [(товар, количество)] со склада одним запросом
+
+    Возвращает [(товар, запрошено всего, новый остаток или None, было в наличии)];
+    None - товара не хватило, он не списан.
+    """
+    if not items:
+        return []
+    product_ids, quantities = (list(column) for column in zip(*items))
+    return conn.run(STOCK_OUT_BATCH_SQL, warehouse_id=warehouse_id, product_ids=product_ids,
+                    quantities=quantities, user_id=user_id)
+
+
+def add_transaction(user, product_id, quantity, transaction_type, warehouse_id=None):
+    """Добавить операцию (списание/пополнение) от имени пользователя user"""
+    if not user:
+        return False, "❌ Пользователь не найден"
+    
     conn = get_db_connection()
     if not conn:
         return False, "❌ Ошибка подключения к БД"
     
     try:
-        user = get_user_by_telegram_id(telegram_id)
-        if not user:
-            return False, "❌ Пользователь не найден"
-        
         # Определяем склад
         target_warehouse = warehouse_id or user['warehouse_id']
         if not target_warehouse:
             return False, "❌ Склад не назначен"
         
-        # Проверяем достаточно ли товара для списания (из таблицы stock)
-        if transaction_type == 'out':
+        new_quantity = move_stock(conn, target_warehouse, product_id, quantity, transaction_type,
+                                  user_id=user['id'])
+        
+        if new_quantity is None:
+            # Списание не прошло - отдельным запросом узнаем, сколько есть
             current = conn.run("""
                 SELECT quantity FROM stock 
                 WHERE product_id = :product_id AND warehouse_id = :warehouse_id
             """, product_id=product_id, warehouse_id=target_warehouse)
-            
-            if not current or current[0][0] is None or current[0][0] < quantity:
-                available = current[0][0] if current and current[0][0] is not None else 0
-                return False, f"❌ Недостаточно товара. Доступно: {available} л."
-        
-        # Обновляем остатки на складе (stock)
-        change = quantity if transaction_type == 'in' else -quantity
-        
-        conn.run("""
-            INSERT INTO stock (warehouse_id, product_id, quantity)
-            VALUES (:warehouse_id, :product_id, :change)
-            ON CONFLICT (warehouse_id, product_id) 
-            DO UPDATE SET quantity = stock.quantity + EXCLUDED.quantity
-        """, warehouse_id=target_warehouse, product_id=product_id, change=change)
-        
-        # Добавляем запись в историю (transactions)
-        # Теперь нужно получить user_id для записи в историю
-        user_result = conn.run("SELECT id FROM users WHERE telegram_id = :telegram_id", 
-                              telegram_id=telegram_id)
-        
-        if user_result:
-            user_id = user_result[0][0]
-            conn.run("""
-                INSERT INTO transactions (product_id, warehouse_id, type, quantity)
-                VALUES (:product_id, :warehouse_id, :type, :quantity)
-            """, product_id=product_id, warehouse_id=target_warehouse, type=transaction_type, quantity=quantity)
+            available = current[0][0] if current and current[0][0] is not None else 0
+            return False, f"❌ Недостаточно товара. Доступно: {available} л."
         
-        return True, f"✅ Товар успешно {'пополнен' if transaction_type == 'in' else 'списан'} в количестве {quantity} л."
+        return True, (f"✅ Товар успешно {'пополнен' if transaction_type == 'in' else 'списан'} "
+                      f"в количестве {quantity} л.\n📦 Остаток на складе: {new_quantity} л.")
         
     except Exception as e:
-        print(f"❌ Error adding transaction: {e}", file=sys.stderr)
+        log.error(f"❌ Error adding transaction: {e}")
         return False, f"❌ Ошибка: {e}"
     finally:
         try:
             conn.close()
         except:
             pass
-# ========== ЭКСПОРТ В EXCEL ==========
-def export_transactions_to_excel(telegram_id, days=30):
-    """Экспорт транзакций в Excel"""
+# ========== ДНЕВНАЯ СВОДКА ОПЕРАЦИЙ ==========
+# Сумма и число операций за день по складу, товару и типу. Обновляется тем же
+# запросом, что пишет операцию (см. STOCK_IN_SQL/STOCK_OUT_SQL), поэтому итоги
+# за период читают сотни строк сводки, а не весь журнал transactions.
+# Таблица создается миграцией 3 (migrations.py).
+def rebuild_rollup(conn):
+    """Пересчитать сводку из журнала операций. Возвращает число строк сводки
+
+    Таблица блокируется от записи на время пересчета: операции, пришедшие
+    параллельно, подождут и добавятся к уже пересчитанной сводке.
+    """
+    conn.run("START TRANSACTION")
+    try:
+        conn.run("LOCK TABLE transaction_daily_rollup IN SHARE ROW EXCLUSIVE MODE")
+        conn.run("DELETE FROM transaction_daily_rollup")
+        conn.run("""
+            INSERT INTO transaction_daily_rollup (day, warehouse_id, product_id, type, quantity, operations)
+            SELECT date::date, warehouse_id, product_id, type, SUM(quantity), COUNT(*)
+            FROM transactions
+            GROUP BY date::date, warehouse_id, product_id, type
+        """)
+        count = conn.run("SELECT COUNT(*) FROM transaction_daily_rollup")[0][0]
+        conn.run("COMMIT")
+        return count
+    except Exception:
+        conn.run("ROLLBACK")
+        raise
+
+
+def period_totals(conn, start_date, warehouse_id=None):
+    """Итоги операций с даты start_date из сводки: [(тип, товар, количество, операций)]
+
+    warehouse_id ограничивает итоги одним складом.
+    """
+    return conn.run("""
+        SELECT CASE WHEN r.type = 'in' THEN 'Приход' ELSE 'Расход' END,
+               p.name, SUM(r.quantity), SUM(r.operations)
+        FROM transaction_daily_rollup r
+        JOIN products p ON r.product_id = p.id
+        WHERE r.day >= :start_date
+          AND (CAST(:warehouse_id AS INTEGER) IS NULL OR r.warehouse_id = :warehouse_id)
+        GROUP BY 1, p.name
+        ORDER BY 1, p.name
+    """, start_date=start_date, warehouse_id=warehouse_id)
+
+# ========== ЭКСПОРТ В ФАЙЛЫ ==========
+def export_transactions_file(user, days=30, fmt='xlsx'):
+    """Экспорт транзакций в файл формата fmt (потоково, см. exports.py)"""
+    if not user or user['role'] != 'admin':
+        return None, "❌ Только для администраторов"
+    
     conn = get_db_connection()
     if not conn:
         return None, "❌ Ошибка подключения к БД"
     
     try:
-        user = get_user_by_telegram_id(telegram_id)
-        if not user or user['role'] != 'admin':
-            return None, "❌ Только для администраторов"
-        
         # Вычисляем дату начала
         start_date = datetime.now() - timedelta(days=days)
         
-        # Получаем транзакции
-        result = conn.run("""
+        # Итоги и строки читаем из одного снимка БД, иначе операция, записанная
+        # между двумя запросами, попадет только на один из листов
+        with exports.snapshot(conn):
+            # Лист итогов - из дневной сводки, а не суммированием строк журнала
+            totals = [(row[0], row[1], row[2]) for row in period_totals(conn, start_date.date())]
+        
+            # Получаем транзакции порциями через курсор
+            rows = exports.iter_query(conn, """
+                SELECT 
+                    t.date,
+                    COALESCE(u.full_name, 'Неизвестный') as пользователь,
+                    w.name as склад,
+                    p.name as товар,
+                    CASE 
+                        WHEN t.type = 'in' THEN 'Приход'
+                        ELSE 'Расход'
+                    END as тип,
+                    t.quantity as количество,
+                    t.notes as примечания
+                FROM transactions t
+                JOIN warehouses w ON t.warehouse_id = w.id
+                LEFT JOIN users u ON t.user_id = u.id
+                JOIN products p ON t.product_id = p.id
+                WHERE t.date >= :start_date
+                ORDER BY t.date DESC, w.name
+            """, in_snapshot=True, start_date=start_date.date())
+        
+            # Курсор закрываем внутри снимка, до возврата подключения в пул
+            # (finally ниже): иначе при ошибке записи он доработает в чужой транзакции
+            with closing(rows):
+                output, count = exports.write_transactions(rows, fmt, totals=totals)
+        if not count:
+            return None, f"📊 Нет операций за последние {days} дней"
+        
+        return output, f"✅ Экспортировано {count} операций"
+        
+    except Exception as e:
+        log.error(f"❌ Error exporting transactions: {e}")
+        return None, f"❌ Ошибка экспорта: {e}"
+    finally:
+        try:
+            conn.close()
+        except:
+            pass
+
+
+def export_balances_file(user, fmt='xlsx'):
+    """Экспорт текущих остатков из таблицы stock в файл формата fmt"""
+    if not user or user['role'] != 'admin':
+        return None, "❌ Только для администраторов"
+    
+    conn = get_db_connection()
+    if not conn:
+        return None, "❌ Ошибка подключения к БД"
+    
+    try:
+        # Получаем остатки из таблицы STOCK (не balances!). Пользователи склада
+        # собираются в одну ячейку, чтобы не умножать строки остатков
+        rows = exports.iter_query(conn, """
             SELECT 
-                t.date,
-                COALESCE(u.full_name, 'Неизвестный') as пользователь,
+                COALESCE((SELECT string_agg(u.full_name, ', ' ORDER BY u.full_name)
+                          FROM users u WHERE u.warehouse_id = w.id),
+                         'Нет пользователя') as пользователи,
                 w.name as склад,
                 p.name as товар,
-                CASE 
-                    WHEN t.type = 'in' THEN 'Приход'
-                    ELSE 'Расход'
-                END as тип,
-                t.quantity as количество,
-                t.notes as примечания
-            FROM transactions t
-            JOIN warehouses w ON t.warehouse_id = w.id
-            LEFT JOIN users u ON w.id = u.warehouse_id
-            JOIN products p ON t.product_id = p.id
-            WHERE t.date >= :start_date
-            ORDER BY t.date DESC, w.name
-        """, start_date=start_date.date())
-        
-        if not result:
-            return None, f"📊 Нет операций за последние {days} дней"
-        
-        # Создаем DataFrame
-        df = pd.DataFrame(result, columns=[
-            'Дата', 'Пользователь', 'Склад', 'Товар', 
-            'Тип операции', 'Количество', 'Примечания'
-        ])
+                s.quantity as остаток,
+                s.updated_at as обновлено
+            FROM stock s
+            JOIN warehouses w ON s.warehouse_id = w.id
+            JOIN products p ON s.product_id = p.id
+            WHERE s.quantity > 0
+            ORDER BY w.name, p.name
+        """)
         
-        # Создаем Excel файл в памяти
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Операции', index=False)
-            
-            # Добавляем итоги
-            summary = df.groupby(['Тип операции', 'Товар'])['Количество'].sum().reset_index()
-            summary.to_excel(writer, sheet_name='Итоги', index=False)
+        with closing(rows):
+            output, count = exports.write_balances(rows, fmt)
+        if not count:
+            return None, "📊 Нет данных об остатках"
         
-        output.seek(0)
-        return output, f"✅ Экспортировано {len(df)} операций"
+        return output, f"✅ Экспортировано {count} записей об остатках"
         
     except Exception as e:
-        print(f"❌ Error exporting transactions: {e}", file=sys.stderr)
+        log.error(f"❌ Error exporting balances: {e}")
         return None, f"❌ Ошибка экспорта: {e}"
     finally:
         try:
@@ -319,90 +1523,251 @@ def export_transactions_to_excel(telegram_id, days=30):
         except:
             pass
 
+
+def export_format(message):
+    """Формат выгрузки из аргумента команды: /export_week csv
+
+    Возвращает ключ exports.FORMATS или None (о чем уже сообщено пользователю).
+    """
+    parts = (message.text or '').split(maxsplit=1)
+    # Кнопки ("📤 Экспорт дня") аргументов не имеют - Excel по умолчанию
+    arg = parts[1] if len(parts) > 1 and parts[0].startswith('/') else None
+    fmt = exports.parse_format(arg)
+    if fmt is None:
+        bot.reply_to(message, "❌ Неизвестный формат. Доступны: xlsx, csv, parquet")
+        return None
+    if fmt == 'parquet' and not exports.PARQUET_AVAILABLE:
+        bot.reply_to(message, "❌ Формат parquet недоступен (не установлен pyarrow). Используйте csv или xlsx")
+        return None
+    return fmt
+
+
+def send_export(message, file_data, message_text, filename, cache_key=None):
+    """Отправить файл выгрузки (или текст ошибки) и освободить временный файл
+
+    С cache_key file_id загруженного файла запоминается в export_cache.
+    """
+    if not file_data:
+        bot.reply_to(message, message_text)
+        return
+    
+    try:
+        sent = bot.send_document(message.chat.id, file_data,
+                                 caption=message_text,
+                                 visible_file_name=filename)
+    finally:
+        file_data.close()
+    
+    if cache_key and sent and sent.document:
+        export_cache.set(cache_key, (sent.document.file_id, message_text))
+
+# ========== КЭШ ВЫГРУЗОК ==========
+EXPORT_CACHE_TTL = float(os.environ.get('EXPORT_CACHE_TTL', 24 * 3600))
+EXPORT_CACHE_SIZE = int(os.environ.get('EXPORT_CACHE_SIZE', 100))
+
+# ключ выгрузки -> (file_id в Telegram, подпись). Файл, однажды загруженный
+# в Telegram, можно переслать по file_id без генерации и повторной загрузки
+export_cache = TTLCache(maxsize=EXPORT_CACHE_SIZE, ttl=EXPORT_CACHE_TTL)
+
+
+def export_cache_key(kind, fmt, period):
+    """Ключ кэша выгрузки или None, если БД недоступна
+
+    Кроме вида отчета, формата и периода в ключ входит "водяной знак"
+    данных, а также версии справочников и пользователей. Пока они не
+    изменились, файл тот же.
+
+    MAX(id) и NOW() выдаются до коммита, поэтому операция, начатая раньше
+    генерации, а закоммиченная позже, их не меняет. Знак должен меняться
+    от любой закоммиченной записи: для операций (журнал только
+    дополняется) это число и сумма строк периода, для остатков - хэш
+    всего содержимого stock (таблица маленькая, выгрузка читает ее целиком).
+    Знак читается до генерации: операция, попавшая между ними, лишь
+    приведет к лишней генерации при следующем запросе.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None
+    
+    try:
+        if kind == 'balances':
+            watermark = conn.run("""
+                SELECT COUNT(*), md5(string_agg(id || ':' || quantity, ',' ORDER BY id))
+                FROM stock
+            """)[0]
+        else:
+            watermark = conn.run("""
+                SELECT COUNT(*), SUM(quantity), MAX(id) FROM transactions
+                WHERE date >= :start_date
+            """, start_date=period)[0]
+    except Exception as e:
+        log.warning(f"⚠️ Export watermark error: {e}")
+        return None
+    finally:
+        conn.close()
+    
+    return (kind, period, fmt, tuple(watermark), catalog.version, users_version)
+
+
+def send_cached_export(message, cache_key):
+    """Переслать ранее отправленный файл по file_id. False - если в кэше его нет"""
+    cached = export_cache.get(cache_key)
+    if cached is TTLCache.MISSING:
+        return False
+    
+    file_id, message_text = cached
+    try:
+        bot.send_document(message.chat.id, file_id, caption=message_text)
+    except apihelper.ApiTelegramException as e:
+        # file_id больше не действителен - сгенерируем файл заново
+        log.warning(f"⚠️ Cached export rejected: {e}")
+        export_cache.invalidate(cache_key)
+        return False
+    return True
+
+
+def run_export(message, kind, title, days=None):
+    """Общий обработчик команд выгрузки: кэш, генерация, отправка
+
+    kind - 'transactions' (за последние days дней) или 'balances'.
+    """
+    fmt = export_format(message)
+    if not fmt:
+        return
+    
+    user = current_user(message)
+    if not user or user['role'] != 'admin':
+        bot.reply_to(message, "❌ Только для администраторов")
+        return
+    
+    now = datetime.now()
+    # Период - дата начала выборки; для остатков - сегодняшняя дата (она в имени файла)
+    period = (now - timedelta(days=days)).date() if kind == 'transactions' else now.date()
+    cache_key = export_cache_key(kind, fmt, period)
+    if cache_key and send_cached_export(message, cache_key):
+        return
+    
+    if kind == 'balances':
+        file_data, message_text = export_balances_file(user, fmt=fmt)
+    else:
+        file_data, message_text = export_transactions_file(user, days=days, fmt=fmt)
+    send_export(message, file_data, message_text,
+                f"{title}_{now.strftime('%d.%m.%Y')}.{exports.FORMATS[fmt]}",
+                cache_key=cache_key)
+
+# ========== ОТЧЕТЫ ==========
+MESSAGE_LIMIT = 4096
+# Если отчет не влезает в столько сообщений - отправляем его файлом
+REPORT_DOCUMENT_THRESHOLD = int(os.environ.get('REPORT_DOCUMENT_THRESHOLD', 5))
+
+
+def escape_md(text):
+    """Экранировать пользовательский текст для parse_mode='Markdown'"""
+    return re.sub(r'([_*`\[])', r'\\\1', str(text))
+
+
+def md_to_plain(text):
+    """Убрать разметку Markdown (для отправки отчета файлом)"""
+    text = re.sub(r'(?<!\\)[*_`]', '', text)
+    return re.sub(r'\\([_*`\[])', r'\1', text)
+
+
+class ReportBuilder:
+    """Отчет, собираемый построчно в куски по размеру сообщения Telegram
+
+    Строки копятся в списке (без квадратичного "+=" по строке), а кусок
+    всегда заканчивается на границе строки - Markdown, открытый в строке,
+    в ней же и закрывается, так что каждый кусок - корректное сообщение.
+    """
+
+    def __init__(self, limit=MESSAGE_LIMIT):
+        self.limit = limit
+        self.chunks = []
+        self._lines = []
+        self._size = 0
+
+    def add(self, line=''):
+        # Строка длиннее лимита (очень длинное название) режется по символам
+        while len(line) > self.limit:
+            self.add(line[:self.limit])
+            line = line[self.limit:]
+        if self._lines and self._size + len(line) + 1 > self.limit:
+            self._flush()
+        self._lines.append(line)
+        self._size += len(line) + 1
+
+    def _flush(self):
+        chunk = '\n'.join(self._lines).strip('\n')
+        if chunk:
+            self.chunks.append(chunk)
+        self._lines = []
+        self._size = 0
+
+    def finish(self):
+        self._flush()
+        return self.chunks
+
+
+def send_report(message, report, parse_mode=None, filename='отчет.txt'):
+    """Отправить отчет несколькими сообщениями или файлом, если он слишком большой"""
+    chunks = report.finish()
+    if not chunks:
+        return
+    
+    if len(chunks) > REPORT_DOCUMENT_THRESHOLD:
+        text = '\n'.join(chunks)
+        if parse_mode == 'Markdown':
+            text = md_to_plain(text)
+        document = BytesIO(text.encode('utf-8'))
+        bot.send_document(message.chat.id, document,
+                          caption=f"📄 Отчет большой ({len(text)} символов) - отправляю файлом",
+                          visible_file_name=filename,
+                          reply_to_message_id=message.message_id)
+        return
+    
+    bot.reply_to(message, chunks[0], parse_mode=parse_mode)
+    for chunk in chunks[1:]:
+        bot.send_message(message.chat.id, chunk, parse_mode=parse_mode)
+
 # ========== КОМАНДЫ БОТА ==========
-@bot.message_handler(commands=['start'])
 def start(message):
     """Начало работы с кнопками"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     
     if not user:
         bot.reply_to(message, "❌ Вы не зарегистрированы в системе. Обратитесь к администратору.")
         return
     
     role = "👑 Администратор" if user['role'] == 'admin' else "👤 Пользователь"
-    warehouse = f"📦 Склад: {user['warehouse_name']}" if user['warehouse_name'] else "📦 Склад не назначен"
-    
-    # Создаем клавиатуру с командами
-    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
-    
-    # Общие команды для всех
-    markup.row('📊 Мои остатки', '📤 Списать')
+    warehouse = (f"📦 Склад: {escape_md(user['warehouse_name'])}" if user['warehouse_name']
+                 else "📦 Склад не назначен")
+    role_key = ROLE_ADMIN if user['role'] == 'admin' else ROLE_USER
     
-    if user['role'] == 'admin':
-        # Команды только для админа
-        markup.row('➕ Товар', '🗑️ Удалить товар', '📋 Товары')  # Добавили 2 новые кнопки
-        markup.row('🏢 Склад', '👤 Пользователь', '📦 Все остатки')
-        markup.row('📋 Список складов', '👥 Список пользователей', '🔄 Пополнить')
-        markup.row('📤 Экспорт дня', '📤 Экспорт недели', '📤 Экспорт месяца')
-        markup.row('📊 Экспорт остатков')
-    
-    # Формируем ответ БЕЗ лишних отступов внутри строки
-    response = f"""✅ *Добро пожаловать, {user['full_name']}!*
+    # Клавиатура и список команд роли собраны один раз из реестра команд
+    response = f"""✅ *Добро пожаловать, {escape_md(user['full_name'])}!*
 
 {role}
 {warehouse}
 
 *Используйте кнопки ниже или команды:*
-"""
-    
-    if user['role'] == 'admin':
-        response += """
-*📋 Все команды:*
-
-📊 /balance - Мои остатки
-📤 /spend - Списать товар
-➕ /add_product - Добавить товар
-📋 /products - Список товаров
-🗑️ /products1 - Удалить товар
-🏢 /add_warehouse - Добавить склад
-👤 /add_user - Добавить пользователя
-📦 /all_balance - Все остатки
-🔄 /add - Пополнить остатки
-📋 /warehouses - Список складов
-👥 /users - Список пользователей
-📤 /export_today - Операции за день
-📤 /export_week - Операции за неделю  
-📤 /export_month - Операции за месяц
-📊 /export_balances - Текущие остатки
-"""
-    else:
-        # ВАЖНО: строки начинаются сразу с текста, без отступов!
 
-        #🗑️ /delete_product - Удалить товар
-        response += """
-📊 /balance - Мои остатки
-📤 /spend - Списать товар
+{HELP_TEXTS[role_key]}
 """
-
-
-
-    
     bot.send_message(message.chat.id, response, 
                      parse_mode='Markdown', 
-                     reply_markup=markup)
+                     reply_markup=MENUS[role_key])
 #=======================================
 #========================================================
 
-@bot.message_handler(commands=['balance'])
 def balance(message):
     """Показать остатки пользователя"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user:
         bot.reply_to(message, "❌ Вы не зарегистрированы.")
         return
     
     # ДЛЯ ВСЕХ пользователей (включая админа) - только их склад
-    balances = get_user_balance(message.from_user.id)
+    balances = get_user_balance(user)
     
     if not balances:
         warehouse_name = user['warehouse_name'] or 'не назначен'
@@ -410,222 +1775,400 @@ def balance(message):
         return
     
     warehouse_name = user['warehouse_name'] or 'не назначен'
-    response = f"📦 ОСТАТКИ НА СКЛАДЕ '{warehouse_name}':\n\n"
+    report = ReportBuilder()
+    report.add(f"📦 ОСТАТКИ НА СКЛАДЕ '{warehouse_name}':")
+    report.add()
     total = 0
     
     for item in balances:
-        response += f"• {item['product']}: {item['quantity']} л.\n"
+        report.add(f"• {item['product']}: {item['quantity']} л.")
         total += item['quantity']
     
-    response += f"\n📊 Всего: {total} л."
-    bot.reply_to(message, response)
+    report.add()
+    report.add(f"📊 Всего: {total} л.")
+    send_report(message, report, filename='остатки.txt')
 
 
-@bot.message_handler(commands=['spend'])
 def spend_command(message):
-    """Списать товар"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    """Списать товар: по шагам или сразу списком /spend 3:5 7:2.5"""
+    user = current_user(message)
     if not user:
         bot.reply_to(message, "❌ Вы не зарегистрированы.")
         return
     
-    # Для админа - запрашиваем склад
-    if user['role'] == 'admin':
-        warehouses = get_all_warehouses()
-        if not warehouses:
-            bot.reply_to(message, "❌ В системе нет складов.")
-            return
-        
-        markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        for warehouse in warehouses:
-            markup.add(f"{warehouse['id']}. {warehouse['name']}")
-        markup.add("❌ Отмена")
-        
-        msg = bot.reply_to(message, "📦 *Выберите склад для списания:*", 
-                          parse_mode='Markdown', 
-                          reply_markup=markup)
-        bot.register_next_step_handler(msg, process_spend_warehouse_admin)
-    
-    else:
-        # Для обычных пользователей - сразу их склад
-        if not user['warehouse_id']:
-            bot.reply_to(message, "❌ Вам не назначен склад. Обратитесь к администратору.")
-            return
-        
-        # Показываем товары только с их склада
-        show_products_for_spend(message, user['warehouse_id'])
-
-def process_spend_warehouse_admin(message):
-    """Обработка выбора склада для админа"""
-    if message.text == "❌ Отмена":
-        bot.reply_to(message, "❌ Отменено", reply_markup=telebot.types.ReplyKeyboardRemove())
+    parts = (message.text or '').split(maxsplit=1)
+    if len(parts) > 1 and parts[0].startswith('/'):
+        stock_batch(message, user, parts[1], 'out')
         return
     
-    try:
-        warehouse_id = int(message.text.split('.')[0])
-        show_products_for_spend(message, warehouse_id)
-    except (ValueError, IndexError):
-        bot.reply_to(message, "❌ Неверный формат", reply_markup=telebot.types.ReplyKeyboardRemove())
-
-def show_products_for_spend(message, warehouse_id, user_id=None):
-    """Показать товары для списания с конкретного склада"""
-    conn = get_db_connection()
-    if not conn:
+    # По шагам - одним сообщением с инлайн-кнопками
+    start_flow(message, FLOW_SPEND)
+
+def find_product(label):
+    """ID товара по ID, точному названию или однозначному началу названия
+
+    Возвращает (ID, None) или (None, причина).
+    """
+    if label.isdigit():
+        product_id = int(label)
+        if product_id in catalog.product_names:
+            return product_id, None
+        return None, f"товар с ID {product_id} не найден"
+    
+    name = label.lower()
+    if name in catalog.product_ids:
+        return catalog.product_ids[name], None
+    matches = [product_id for product_name, product_id in catalog.product_ids.items()
+               if product_name.startswith(name)]
+    if len(matches) == 1:
+        return matches[0], None
+    if not matches:
+        return None, f"товар '{label}' не найден"
+    return None, f"'{label}' подходит к {len(matches)} товарам, уточните"
+
+
+def stock_batch(message, user, text, transaction_type='out'):
+    """Списание (или пополнение) списком одним сообщением: /spend [@склад] 3:5 7:2.5 мерло:1
+
+    Все найденные позиции проводятся одним запросом; в ответе - новые
+    остатки и позиции, которые провести не удалось.
+    """
+    command = 'spend' if transaction_type == 'out' else 'add'
+    done_label, failed_label = (("Списано со склада", "Не списано") if transaction_type == 'out'
+                                else ("Пополнен склад", "Не пополнено"))
+    if not catalog.ensure_fresh():
         bot.reply_to(message, "❌ Ошибка подключения к БД")
         return
     
-    try:
-        # Получаем товары с остатками > 0 на этом складе (из stock)
-        result = conn.run("""
-            SELECT p.id, p.name, COALESCE(s.quantity, 0) as quantity
-            FROM products p
-            LEFT JOIN stock s ON p.id = s.product_id AND s.warehouse_id = :warehouse_id
-            WHERE COALESCE(s.quantity, 0) > 0
-            ORDER BY p.name
-        """, warehouse_id=warehouse_id)
-        
-        if not result:
-            # Получаем название склада для сообщения
-            warehouse_name = conn.run("SELECT name FROM warehouses WHERE id = :id", id=warehouse_id)
-            warehouse_name = warehouse_name[0][0] if warehouse_name else "этом складе"
-            
-            bot.reply_to(message, f"📦 На складе '{warehouse_name}' нет товаров для списания.")
-            return
-        
-        markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        
-        response = "📝 *Выберите товар для списания:*\n\n"
-        for product_id, product_name, quantity in result:
-            markup.add(f"{product_id}. {product_name} ({quantity} л.)")
-            response += f"*{product_id}.* {product_name} - {quantity} л.\n"
-        
-        markup.add("❌ Отмена")
-        
-        # Сохраняем warehouse_id для следующего шага
-        msg = bot.send_message(message.chat.id, response, 
-                              parse_mode='Markdown', 
-                              reply_markup=markup)
-        bot.register_next_step_handler(msg, process_spend_product_with_warehouse, warehouse_id)
-        
-    except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка: {e}")
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
-
-def process_spend_product_with_warehouse(message, warehouse_id):
-    """Обработка выбора товара с учетом склада"""
-    if message.text == "❌ Отмена":
-        bot.reply_to(message, "❌ Отменено", reply_markup=telebot.types.ReplyKeyboardRemove())
+    # Админ может указать склад: /spend @2 3:5 (для пополнения - обязательно)
+    warehouse_id = user['warehouse_id'] if transaction_type == 'out' else None
+    match = re.match(r'\s*@(\d+)\s*', text)
+    if match and user['role'] == 'admin':
+        warehouse_id = int(match.group(1))
+        text = text[match.end():]
+    if not warehouse_id or warehouse_id not in catalog.warehouse_names:
+        bot.reply_to(message, "❌ Склад не назначен или не найден"
+                              + (f" (укажите склад: /{command} @ID 3:5)" if user['role'] == 'admin' else ""))
         return
     
-    try:
-        text = message.text.strip()
-        
-        # Парсим ID товара (формат: "1. Вино Красное (88 л.)" или просто "1")
-        if '.' in text:
-            product_id = int(text.split('.')[0].strip())
+    items, junk = parse_spend_items(text)
+    # Непонятный кусок значит, что сообщение понято не так, как задумано
+    # (например, "3:2 7" вместо "3:2 7:1") - ничего не проводим
+    if junk:
+        bot.reply_to(message, "❌ Не понял: " + ", ".join(f"'{piece}'" for piece in junk)
+                              + f"\nОжидается товар:количество, например /{command} 3:5 7:2,5. "
+                              "Ничего не изменено.")
+        return
+    rejected = []
+    accepted = []
+    for label, quantity in items:
+        product_id, error = find_product(label)
+        if error:
+            rejected.append(error)
+        elif quantity <= 0:
+            rejected.append(f"{label}: количество должно быть больше 0")
         else:
-            product_id = int(text)
-        
-        # Запрашиваем количество
-        msg = bot.reply_to(message, "📝 Введите количество для списания:", 
-                          reply_markup=telebot.types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(msg, process_spend_quantity_with_warehouse, warehouse_id, product_id)
-        
-    except (ValueError, IndexError):
-        bot.reply_to(message, "❌ Неверный формат. Введите номер товара.", 
-                    reply_markup=telebot.types.ReplyKeyboardRemove())
-
-def process_spend_quantity_with_warehouse(message, warehouse_id, product_id):
-    """Обработка количества для списания с учетом склада"""
-    try:
-        quantity = int(message.text)
-        if quantity <= 0:
-            bot.reply_to(message, "❌ Количество должно быть больше 0")
-            return
-        
-        # Получаем пользователя на этом складе
+            accepted.append((product_id, quantity))
+    
+    results = []
+    if accepted:
         conn = get_db_connection()
         if not conn:
             bot.reply_to(message, "❌ Ошибка подключения к БД")
             return
-        
-        user_result = conn.run("""
-            SELECT telegram_id FROM users 
-            WHERE warehouse_id = :warehouse_id
-            LIMIT 1
-        """, warehouse_id=warehouse_id)
-        
-        conn.close()
-        
-        if not user_result:
-            bot.reply_to(message, "❌ На этом складе нет пользователя")
+        try:
+            if transaction_type == 'out':
+                results = spend_stock_batch(conn, warehouse_id, accepted, user_id=user['id'])
+            else:
+                balances = receive_stock_batch(conn, [(warehouse_id, product_id, quantity)
+                                                      for product_id, quantity in accepted],
+                                               user_id=user['id'])
+                requested = {}
+                for product_id, quantity in accepted:
+                    requested[product_id] = requested.get(product_id, 0) + quantity
+                results = [(product_id, requested[product_id], new_quantity, None)
+                           for _, product_id, new_quantity in balances]
+        except Exception as e:
+            bot.reply_to(message, f"❌ Ошибка, остатки не изменены: {e}")
             return
-        
-        telegram_id = user_result[0][0]
-        
-        # Выполняем списание
-        success, result_message = add_transaction(telegram_id, product_id, quantity, 'out', warehouse_id)
-        bot.reply_to(message, result_message)
-        
-    except ValueError:
-        bot.reply_to(message, "❌ Введите число")
+        finally:
+            conn.close()
+    
+    report = ReportBuilder()
+    spent = [row for row in results if row[2] is not None]
+    if spent:
+        report.add(f"✅ {done_label} '{catalog.warehouse_names[warehouse_id]}':")
+        for product_id, quantity, new_quantity, _ in spent:
+            report.add(f"  • {catalog.product_names.get(product_id, product_id)}: "
+                       f"{quantity} л. → остаток {new_quantity} л.")
+    for product_id, quantity, new_quantity, available in results:
+        if new_quantity is None:
+            rejected.append(f"{catalog.product_names.get(product_id, product_id)}: "
+                            f"недостаточно ({quantity} л.), доступно {available} л.")
+    if rejected:
+        if spent:
+            report.add()
+        report.add(f"⚠️ {failed_label}:")
+        for reason in rejected:
+            report.add(f"  • {reason}")
+    
+    send_report(message, report, filename=f'{command}.txt')
+
+
+# ========== ИНЛАЙН-КЛАВИАТУРЫ СПИСАНИЯ И ПОПОЛНЕНИЯ ==========
+# Списание и пополнение - одно сообщение, которое редактируется на месте.
+# Все, что выбрано на предыдущих шагах, едет в callback_data кнопки:
+# "поток:склад:товар:количество:страница" (пустые поля - еще не выбрано),
+# поток - FLOW_SPEND или FLOW_ADD. Состояние на сервере не хранится, так что
+# нажатие обработает любой рабочий поток, в том числе после перезапуска.
+FLOW_SPEND = 's'
+FLOW_ADD = 'a'
+CALLBACK_CANCEL = 'x'
+QUANTITY_PRESETS = (1, 2, 3, 5, 10, 20, 50, 100)
+INLINE_PAGE_SIZE = 20
+
+# Сообщения, по которым операция уже выполнена: повторное нажатие
+# (двойной тап) не должно списать товар второй раз
+completed_flows = TTLCache(maxsize=10000, ttl=3600)
+
+
+def flow_data(flow, warehouse_id=None, product_id=None, quantity=None, page=None):
+    """callback_data шага (до 64 байт - укладываемся с запасом)"""
+    fields = (warehouse_id, product_id, quantity, page)
+    return ':'.join([flow] + ['' if value is None else str(value) for value in fields])
+
+
+def parse_flow_data(data):
+    """callback_data -> (поток, склад, товар, количество, страница); ValueError - мусор"""
+    flow, *fields = data.split(':')
+    fields += [''] * (4 - len(fields))
+    warehouse_id, product_id, page = (int(value) if value else None for value in (fields[0], fields[1], fields[3]))
+    # Количество дробное: кнопка "весь остаток" может быть 0.5 л.
+    try:
+        quantity = Decimal(fields[2]) if fields[2] else None
+    except InvalidOperation:
+        raise ValueError(f"bad quantity: {fields[2]!r}")
+    if quantity is not None and not quantity.is_finite():
+        raise ValueError(f"bad quantity: {fields[2]!r}")
+    return flow, warehouse_id, product_id, quantity, page
+
+
+def inline_markup(buttons, back=None, row_width=2):
+    """Клавиатура из [(текст, callback_data)] + строка "Назад/Отмена" """
+    markup = telebot.types.InlineKeyboardMarkup(row_width=row_width)
+    markup.add(*[telebot.types.InlineKeyboardButton(text, callback_data=data) for text, data in buttons])
+    controls = []
+    if back:
+        controls.append(telebot.types.InlineKeyboardButton("⬅️ Назад", callback_data=back))
+    controls.append(telebot.types.InlineKeyboardButton("❌ Отмена", callback_data=CALLBACK_CANCEL))
+    markup.row(*controls)
+    return markup
+
+
+def paged(buttons, flow, warehouse_id, page):
+    """Одна страница списка кнопок + стрелки листания"""
+    page = page or 0
+    start = page * INLINE_PAGE_SIZE
+    shown = buttons[start:start + INLINE_PAGE_SIZE]
+    if page > 0:
+        shown.append(("◀️", flow_data(flow, warehouse_id, page=page - 1)))
+    if start + INLINE_PAGE_SIZE < len(buttons):
+        shown.append(("▶️", flow_data(flow, warehouse_id, page=page + 1)))
+    return shown
+
+
+def warehouse_users():
+    """{склад: "ФИО, ФИО"} одним запросом"""
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    try:
+        rows = conn.run("""
+            SELECT warehouse_id, STRING_AGG(full_name, ', ' ORDER BY full_name)
+            FROM users
+            WHERE warehouse_id IS NOT NULL
+            GROUP BY warehouse_id
+        """)
+        return dict(rows)
+    except Exception as e:
+        log.error(f"❌ Error loading warehouse users: {e}")
+        return {}
+    finally:
+        conn.close()
 
 
-def process_spend_product(message):
-    """Обработка выбора товара для списания"""
-    if message.text == "❌ Отмена":
-        bot.reply_to(message, "❌ Отменено", reply_markup=telebot.types.ReplyKeyboardRemove())
-        return
-    
+def warehouse_stock(warehouse_id, product_id=None):
+    """[(товар, остаток)] склада с ненулевым остатком (или одного товара)"""
+    conn = get_db_connection()
+    if not conn:
+        return None
     try:
-        # Пробуем разные форматы ввода
-        text = message.text.strip()
-        
-        # Формат 1: "2. Вино Белое" -> берем первое число
-        if '.' in text:
-            product_id = int(text.split('.')[0].strip())
-        # Формат 2: просто число "1"
+        return conn.run("""
+            SELECT s.product_id, s.quantity
+            FROM stock s
+            WHERE s.warehouse_id = :warehouse_id AND s.quantity > 0
+              AND (CAST(:product_id AS INTEGER) IS NULL OR s.product_id = :product_id)
+        """, warehouse_id=warehouse_id, product_id=product_id)
+    finally:
+        conn.close()
+
+
+def flow_step(flow, user, warehouse_id=None, product_id=None, quantity=None, page=None):
+    """Текст и клавиатура очередного шага потока (клавиатура None - поток завершен)
+
+    Права проверяются на каждом шаге: callback_data приходит от клиента.
+    """
+    admin = user['role'] == 'admin'
+    if flow == FLOW_ADD and not admin:
+        return "❌ Только для администраторов", None
+    if flow == FLOW_SPEND and not admin:
+        if not user['warehouse_id']:
+            return "❌ Вам не назначен склад. Обратитесь к администратору.", None
+        if warehouse_id not in (None, user['warehouse_id']):
+            return "❌ Можно списывать только со своего склада", None
+        warehouse_id = user['warehouse_id']
+    
+    if not catalog.ensure_fresh():
+        return "❌ Ошибка подключения к БД", None
+    action = "списания" if flow == FLOW_SPEND else "пополнения"
+    
+    # Шаг 1: склад
+    if warehouse_id is None:
+        if not catalog.warehouses:
+            return escape_md("❌ В системе нет складов. Сначала /add_warehouse"), None
+        users = warehouse_users() if flow == FLOW_ADD else {}
+        buttons = []
+        for warehouse in catalog.warehouses:
+            label = warehouse['name']
+            if warehouse['id'] in users:
+                label += f" ({users[warehouse['id']]})"
+            buttons.append((label, flow_data(flow, warehouse['id'])))
+        return f"📦 *Выберите склад для {action}:*", inline_markup(buttons, row_width=1)
+    
+    warehouse_name = catalog.warehouse_names.get(warehouse_id)
+    if warehouse_name is None:
+        return "❌ Склад не найден", None
+    back_to_warehouses = flow_data(flow) if admin else None
+    
+    # Шаг 2: товар (для списания - только то, что есть на складе)
+    if product_id is None:
+        if flow == FLOW_SPEND:
+            stock = warehouse_stock(warehouse_id)
+            if stock is None:
+                return "❌ Ошибка подключения к БД", None
+            if not stock:
+                return f"📦 На складе '{escape_md(warehouse_name)}' нет товаров для списания.", None
+            items = sorted(((catalog.product_names.get(pid, str(pid)), pid, qty) for pid, qty in stock))
+            buttons = [(f"{name} ({qty} л.)", flow_data(flow, warehouse_id, pid)) for name, pid, qty in items]
         else:
-            product_id = int(text)
-        
-        # Запрашиваем количество
-        msg = bot.reply_to(message, "📝 Введите количество для списания:", 
-                          reply_markup=telebot.types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(msg, process_spend_quantity, product_id)
-        
-    except (ValueError, IndexError):
-        # Если не удалось распарсить
-        bot.reply_to(message, "❌ Неверный формат. Введите номер товара или выберите из списка.", 
-                    reply_markup=telebot.types.ReplyKeyboardRemove())
+            if not catalog.products:
+                return "❌ В системе нет товаров", None
+            buttons = [(product['name'], flow_data(flow, warehouse_id, product['id']))
+                       for product in catalog.products]
+        return (f"📝 *Выберите товар для {action}*\n🏢 Склад: {escape_md(warehouse_name)}",
+                inline_markup(paged(buttons, flow, warehouse_id, page), back=back_to_warehouses))
+    
+    product_name = catalog.product_names.get(product_id)
+    if product_name is None:
+        return "❌ Товар не найден", None
+    
+    # Шаг 3: количество
+    if quantity is None:
+        text = f"🏢 Склад: {escape_md(warehouse_name)}\n🍷 Товар: {escape_md(product_name)}\n"
+        presets = QUANTITY_PRESETS
+        if flow == FLOW_SPEND:
+            stock = warehouse_stock(warehouse_id, product_id)
+            available = stock[0][1] if stock else 0
+            text += f"📦 Доступно: {available} л.\n"
+            if available <= 0:
+                return text + "❌ Списывать нечего", inline_markup([], back=flow_data(flow, warehouse_id))
+            presets = [preset for preset in presets if preset < available]
+        command = 'spend' if flow == FLOW_SPEND else 'add'
+        warehouse_arg = f"@{warehouse_id} " if admin else ""
+        text += f"\n*Сколько {'списать' if flow == FLOW_SPEND else 'добавить'}?*\n" \
+                f"Другое количество: /{command} {warehouse_arg}{product_id}:2.5"
+        buttons = [(f"{preset} л.", flow_data(flow, warehouse_id, product_id, preset)) for preset in presets]
+        if flow == FLOW_SPEND:
+            # Остаток меньше литра (обычное дело для вина) тоже можно списать кнопкой
+            buttons.append((f"Весь остаток ({available} л.)",
+                            flow_data(flow, warehouse_id, product_id, available)))
+        return text, inline_markup(buttons, back=flow_data(flow, warehouse_id), row_width=4)
+    
+    # Шаг 4: выполняем операцию от имени нажавшего
+    if quantity <= 0:
+        return "❌ Количество должно быть больше 0", None
+    transaction_type = 'out' if flow == FLOW_SPEND else 'in'
+    success, result_message = add_transaction(user, product_id, quantity, transaction_type, warehouse_id)
+    return f"🍷 {escape_md(product_name)} - {escape_md(warehouse_name)}\n{escape_md(result_message)}", None
+
+
+def start_flow(message, flow):
+    """Первое (и единственное) сообщение потока"""
+    user = current_user(message)
+    if not user:
+        bot.reply_to(message, "❌ Вы не зарегистрированы.")
+        return
+    text, markup = flow_step(flow, user)
+    bot.reply_to(message, text, parse_mode='Markdown', reply_markup=markup)
 
 
-def process_spend_quantity(message, product_id):
-    """Обработка количества для списания"""
+@bot.callback_query_handler(func=lambda call: bool(call.data) and call.data.split(':', 1)[0] in
+                            (FLOW_SPEND, FLOW_ADD, CALLBACK_CANCEL))
+def edit_flow_message(message, text, markup=None, parse_mode=None):
+    """Обновить сообщение потока; повторное нажатие той же кнопки не ошибка"""
     try:
-        quantity = int(message.text)
-        if quantity <= 0:
-            bot.reply_to(message, "❌ Количество должно быть больше 0")
-            return
-        
-        # Выполняем списание
-        success, result_message = add_transaction(message.from_user.id, product_id, quantity, 'out')
-        
-        bot.reply_to(message, result_message)
-        
+        bot.edit_message_text(text, message.chat.id, message.message_id,
+                              parse_mode=parse_mode, reply_markup=markup)
+    except apihelper.ApiTelegramException as e:
+        # Двойное нажатие перерисовывает тот же шаг - Telegram отвечает 400
+        if 'message is not modified' not in (e.description or ''):
+            raise
+
+
+def flow_callback(call):
+    """Нажатие кнопки в сообщении списания/пополнения"""
+    set_log_fields(handler='flow_callback')
+    message = call.message
+    user = current_user(call)
+    if not user:
+        bot.answer_callback_query(call.id, "❌ Вы не зарегистрированы", show_alert=True)
+        return
+    
+    # В группе кнопки видят все: нажимать их может только тот, кто начал поток
+    # (сообщение потока - ответ на его команду)
+    command_message = getattr(message, 'reply_to_message', None)  # у InaccessibleMessage его нет
+    started_by = command_message.from_user if command_message else None
+    if started_by and started_by.id != call.from_user.id:
+        bot.answer_callback_query(call.id, "❌ Эти кнопки для другого пользователя", show_alert=True)
+        return
+    
+    if call.data == CALLBACK_CANCEL:
+        bot.answer_callback_query(call.id)
+        edit_flow_message(message, "❌ Отменено")
+        return
+    
+    try:
+        flow, warehouse_id, product_id, quantity, page = parse_flow_data(call.data)
     except ValueError:
-        bot.reply_to(message, "❌ Введите число")
-
+        bot.answer_callback_query(call.id, "❌ Устаревшая кнопка")
+        return
+    
+    if quantity is not None:
+        key = (message.chat.id, message.message_id)
+        if completed_flows.get(key) is not TTLCache.MISSING:
+            bot.answer_callback_query(call.id, "Уже выполнено")
+            return
+        completed_flows.set(key, True)
+    
+    bot.answer_callback_query(call.id)
+    text, markup = flow_step(flow, user, warehouse_id, product_id, quantity, page)
+    edit_flow_message(message, text, markup, parse_mode='Markdown')
 
 
 # ========== АДМИН КОМАНДЫ ==========
-@bot.message_handler(commands=['add_product'])
 def add_product_command(message):
     """Добавить товар (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -656,24 +2199,13 @@ def process_add_product(message):
             bot.reply_to(message, f"❌ Товар '{product_name}' уже существует (ID: {existing[0][0]})")
             return
         
-        # Добавляем новый товар
-        conn.run("INSERT INTO products (name) VALUES (:name)", name=product_name)
-        
-        # Получаем ID нового товара
-        new_product = conn.run("SELECT id FROM products WHERE name = :name", name=product_name)
+        # Добавляем новый товар. Нулевые остатки не создаем: строка stock
+        # появится при первом пополнении
+        new_product = conn.run("INSERT INTO products (name) VALUES (:name) RETURNING id", name=product_name)
+        catalog.invalidate()
         
         if new_product:
             product_id = new_product[0][0]
-            
-            # Создаем нулевые остатки на всех складах для нового товара
-            warehouses = conn.run("SELECT id FROM warehouses")
-            for warehouse in warehouses:
-                conn.run("""
-                    INSERT INTO stock (warehouse_id, product_id, quantity)
-                    VALUES (:warehouse_id, :product_id, 0)
-                    ON CONFLICT (warehouse_id, product_id) DO NOTHING
-                """, warehouse_id=warehouse[0], product_id=product_id)
-            
             bot.reply_to(message, f"✅ Товар '{product_name}' успешно добавлен (ID: {product_id})")
         else:
             bot.reply_to(message, "❌ Не удалось добавить товар")
@@ -690,10 +2222,9 @@ def process_add_product(message):
         except:
             pass
 
-@bot.message_handler(commands=['add_warehouse'])
 def add_warehouse_command(message):
     """Добавить склад (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -715,6 +2246,7 @@ def process_add_warehouse(message):
     
     try:
         conn.run("INSERT INTO warehouses (name) VALUES (:name)", name=warehouse_name)
+        catalog.invalidate()
         bot.reply_to(message, f"✅ Склад '{warehouse_name}' успешно добавлен")
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {e}")
@@ -724,10 +2256,9 @@ def process_add_warehouse(message):
         except:
             pass
 
-@bot.message_handler(commands=['all_balance'])
 def all_balance_command(message):
     """Все остатки (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -745,179 +2276,69 @@ def all_balance_command(message):
                 p.name as товар,
                 COALESCE(s.quantity, 0) as остаток
             FROM stock s
-            JOIN warehouses w ON s.warehouse_id = w.id
-            JOIN products p ON s.product_id = p.id
-            WHERE s.quantity > 0
-            ORDER BY w.name, p.name
-        """)
-        
-        if not result:
-            bot.reply_to(message, "📦 В системе нет остатков.")
-            return
-        
-        response = "📦 ОСТАТКИ ПО ВСЕМ СКЛАДАМ:\n\n"
-        current_warehouse = None
-        warehouse_count = {}
-        
-        for warehouse_name, product_name, quantity in result:
-            if warehouse_name != current_warehouse:
-                response += f"\n🏢 *{warehouse_name}:*\n"
-                current_warehouse = warehouse_name
-                warehouse_count[warehouse_name] = 0
-            
-            response += f"  • {product_name}: {quantity} л.\n"
-            warehouse_count[warehouse_name] += 1
-        
-        # Добавляем статистику
-        response += f"\n📊 *Статистика:*"
-        for warehouse_name, count in warehouse_count.items():
-            response += f"\n🏢 {warehouse_name}: {count} позиций"
-        
-        total_items = sum(warehouse_count.values())
-        response += f"\n\n📈 Всего позиций в системе: {total_items}"
-        
-        bot.reply_to(message, response, parse_mode='Markdown')
-        
-    except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка: {e}")
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
-
-@bot.message_handler(commands=['add'])
-def add_stock_command(message):
-    """Пополнить склад (админ) - УПРОЩЕННАЯ ВЕРСИЯ"""
-    user = get_user_by_telegram_id(message.from_user.id)
-    if not user or user['role'] != 'admin':
-        bot.reply_to(message, "❌ Только для администраторов")
-        return
-    
-    # Запрашиваем склад
-    warehouses = get_all_warehouses()
-    if not warehouses:
-        bot.reply_to(message, "❌ В системе нет складов. Сначала /add_warehouse")
-        return
-    
-    markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-    
-    # Показываем склады с пользователями
-    conn = get_db_connection()
-    if conn:
-        for warehouse in warehouses:
-            # Получаем пользователя на этом складе
-            user_result = conn.run("""
-                SELECT u.full_name FROM users u 
-                WHERE u.warehouse_id = :warehouse_id
-                LIMIT 1
-            """, warehouse_id=warehouse['id'])
-            
-            user_name = user_result[0][0] if user_result else "нет пользователя"
-            markup.add(f"{warehouse['id']}. {warehouse['name']} ({user_name})")
-        
-        conn.close()
-    
-    markup.add("❌ Отмена")
-    
-    msg = bot.reply_to(message, "📦 *Выберите склад для пополнения:*", 
-                      parse_mode='Markdown', 
-                      reply_markup=markup)
-    bot.register_next_step_handler(msg, process_add_warehouse_simple)
-
-def process_add_warehouse_simple(message):
-    """Обработка выбора склада (упрощенная)"""
-    if message.text == "❌ Отмена":
-        bot.reply_to(message, "❌ Отменено", reply_markup=telebot.types.ReplyKeyboardRemove())
-        return
-    
-    try:
-        warehouse_id = int(message.text.split('.')[0])
+            JOIN warehouses w ON s.warehouse_id = w.id
+            JOIN products p ON s.product_id = p.id
+            WHERE s.quantity > 0
+            ORDER BY w.name, p.name
+        """)
         
-        # Получаем пользователя на этом складе
-        conn = get_db_connection()
-        if not conn:
-            bot.reply_to(message, "❌ Ошибка подключения к БД", 
-                        reply_markup=telebot.types.ReplyKeyboardRemove())
+        if not result:
+            bot.reply_to(message, "📦 В системе нет остатков.")
             return
         
-        user_result = conn.run("""
-            SELECT u.telegram_id, u.full_name FROM users u 
-            WHERE u.warehouse_id = :warehouse_id
-            LIMIT 1
-        """, warehouse_id=warehouse_id)
-        
-        conn.close()
-        
-        if not user_result:
-            bot.reply_to(message, "❌ На этом складе нет пользователя", 
-                        reply_markup=telebot.types.ReplyKeyboardRemove())
-            return
+        report = ReportBuilder()
+        report.add("📦 ОСТАТКИ ПО ВСЕМ СКЛАДАМ:")
+        current_warehouse = None
+        warehouse_count = {}
         
-        telegram_id, full_name = user_result[0]
+        for warehouse_name, product_name, quantity in result:
+            if warehouse_name != current_warehouse:
+                report.add()
+                report.add(f"🏢 *{warehouse_name.replace('*', '')}:*")
+                current_warehouse = warehouse_name
+                warehouse_count[warehouse_name] = 0
+            
+            report.add(f"  • {escape_md(product_name)}: {quantity} л.")
+            warehouse_count[warehouse_name] += 1
         
-        # Запрашиваем товар
-        products = get_all_products()
-        if not products:
-            bot.reply_to(message, "❌ В системе нет товаров", 
-                        reply_markup=telebot.types.ReplyKeyboardRemove())
-            return
+        # Добавляем статистику
+        report.add()
+        report.add("📊 *Статистика:*")
+        for warehouse_name, count in warehouse_count.items():
+            report.add(f"🏢 {escape_md(warehouse_name)}: {count} позиций")
         
-        markup = telebot.types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        for product in products:
-            markup.add(f"{product['id']}. {product['name']}")
-        markup.add("❌ Отмена")
+        total_items = sum(warehouse_count.values())
+        report.add()
+        report.add(f"📈 Всего позиций в системе: {total_items}")
         
-        msg = bot.reply_to(message, f"📝 Выберите товар для пополнения склада *{full_name}*:", 
-                          parse_mode='Markdown', 
-                          reply_markup=markup)
-        bot.register_next_step_handler(msg, process_add_product_simple, warehouse_id, telegram_id)
+        send_report(message, report, parse_mode='Markdown', filename='все_остатки.txt')
         
-    except (ValueError, IndexError):
-        bot.reply_to(message, "❌ Неверный формат. Выберите склад из списка.", 
-                    reply_markup=telebot.types.ReplyKeyboardRemove())
+    except Exception as e:
+        bot.reply_to(message, f"❌ Ошибка: {e}")
+    finally:
+        try:
+            conn.close()
+        except:
+            pass
 
-def process_add_product_simple(message, warehouse_id, telegram_id):
-    """Обработка выбора товара (упрощенная)"""
-    if message.text == "❌ Отмена":
-        bot.reply_to(message, "❌ Отменено", reply_markup=telebot.types.ReplyKeyboardRemove())
+def add_stock_command(message):
+    """Пополнить склад (админ): по шагам кнопками или списком /add 3:5 7:2.5"""
+    user = current_user(message)
+    if not user or user['role'] != 'admin':
+        bot.reply_to(message, "❌ Только для администраторов")
         return
     
-    try:
-        product_id = int(message.text.split('.')[0])
-        
-        # Запрашиваем количество
-        msg = bot.reply_to(message, "📝 Введите количество для пополнения:", 
-                          reply_markup=telebot.types.ReplyKeyboardRemove())
-        bot.register_next_step_handler(msg, process_add_quantity_simple, warehouse_id, telegram_id, product_id)
-        
-    except (ValueError, IndexError):
-        bot.reply_to(message, "❌ Неверный формат. Выберите товар из списка.", 
-                    reply_markup=telebot.types.ReplyKeyboardRemove())
-
-def process_add_quantity_simple(message, warehouse_id, telegram_id, product_id):
-    """Обработка количества для пополнения (упрощенная)"""
-    try:
-        quantity = int(message.text)
-        if quantity <= 0:
-            bot.reply_to(message, "❌ Количество должно быть больше 0")
-            return
-        
-        # Выполняем пополнение
-        success, result_message = add_transaction(telegram_id, product_id, quantity, 'in', warehouse_id)
-        bot.reply_to(message, result_message)
-        
-    except ValueError:
-        bot.reply_to(message, "❌ Введите число")
-
-
-
+    parts = (message.text or '').split(maxsplit=1)
+    if len(parts) > 1 and parts[0].startswith('/'):
+        stock_batch(message, user, parts[1], 'in')
+        return
+    
+    start_flow(message, FLOW_ADD)
 
 
-@bot.message_handler(commands=['add_user'])
 def add_user_command(message):
     """Добавить пользователя (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -930,18 +2351,14 @@ def process_add_user_telegram_id(message):
     try:
         telegram_id = int(message.text)
         
-        print(f"DEBUG: process_add_user_telegram_id: checking telegram_id={telegram_id}", file=sys.stderr)
-        
         # Проверяем, не существует ли уже
         existing = get_user_by_telegram_id(telegram_id)
+        log.debug("add_user: telegram_id checked", extra=kv(telegram_id=telegram_id, exists=bool(existing)))
         
         if existing:
-            print(f"DEBUG: User EXISTS: {existing['full_name']}", file=sys.stderr)
             bot.reply_to(message, f"❌ Пользователь с ID {telegram_id} уже существует ({existing['full_name']})")
             return
         
-        print(f"DEBUG: User NOT found, continuing...", file=sys.stderr)
-        
         msg = bot.reply_to(message, "📝 Введите имя нового пользователя:")
         bot.register_next_step_handler(msg, process_add_user_name, telegram_id)
     except ValueError:
@@ -987,7 +2404,7 @@ def process_add_user_warehouse(message, telegram_id, full_name):
         role = 'admin' if telegram_id in ADMIN_IDS else 'user'
         
         try:
-            conn.run("""
+            result = conn.run("""
                 INSERT INTO users (telegram_id, full_name, role, warehouse_id) 
                 VALUES (:telegram_id, :full_name, :role, :warehouse_id)
                 ON CONFLICT (telegram_id) 
@@ -997,27 +2414,14 @@ def process_add_user_warehouse(message, telegram_id, full_name):
                     warehouse_id = EXCLUDED.warehouse_id
                 RETURNING id
             """, telegram_id=telegram_id, full_name=full_name, role=role, warehouse_id=warehouse_id)
-            
-            # Получаем ID пользователя
-            result = conn.run("SELECT id FROM users WHERE telegram_id = :telegram_id", 
-                             telegram_id=telegram_id)
+            invalidate_user(telegram_id)
             
             if not result:
                 bot.reply_to(message, "❌ Не удалось создать/обновить пользователя", 
                             reply_markup=telebot.types.ReplyKeyboardRemove())
                 return
             
-            user_id = result[0][0]
-            
-            # Инициализируем нулевые остатки в stock (НЕ В balances!)
-            products = get_all_products()
-            for product in products:
-                conn.run("""
-                    INSERT INTO stock (warehouse_id, product_id, quantity)
-                    VALUES (:warehouse_id, :product_id, 0)
-                    ON CONFLICT (warehouse_id, product_id) DO NOTHING
-                """, warehouse_id=warehouse_id, product_id=product['id'])
-            
+            # Нулевые остатки в stock не нужны: нет строки - остаток 0
             bot.reply_to(message, f"✅ Пользователь {full_name} (ID: {telegram_id}) успешно добавлен!", 
                         reply_markup=telebot.types.ReplyKeyboardRemove())
             
@@ -1039,10 +2443,9 @@ def process_add_user_warehouse(message, telegram_id, full_name):
 
 
 
-@bot.message_handler(commands=['warehouses'])
 def warehouses_command(message):
     """Список складов с пользователями (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -1074,16 +2477,18 @@ def warehouses_command(message):
             bot.reply_to(message, "📦 В системе нет складов")
             return
         
-        response = "📋 СПИСОК СКЛАДОВ:\n\n"
+        report = ReportBuilder()
+        report.add("📋 СПИСОК СКЛАДОВ:")
+        report.add()
         
         for row in result:
             warehouse_id, name, user_count, users = row
             users_list = users if users else "нет пользователей"
-            response += f"🏢 {name} (ID: {warehouse_id})\n"
-            response += f"   👥 Пользователей: {user_count}\n"
-            response += f"   📝 Пользователи: {users_list}\n\n"
+            report.add(f"🏢 {name} (ID: {warehouse_id})\n"
+                       f"   👥 Пользователей: {user_count}\n"
+                       f"   📝 Пользователи: {users_list}\n")
         
-        bot.reply_to(message, response)
+        send_report(message, report, filename='склады.txt')
         
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {e}")
@@ -1094,10 +2499,9 @@ def warehouses_command(message):
             pass
 
 
-@bot.message_handler(commands=['users'])
 def users_command(message):
     """Список пользователей (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -1119,17 +2523,19 @@ def users_command(message):
             bot.reply_to(message, "👥 В системе нет пользователей")
             return
         
-        response = "📋 СПИСОК ПОЛЬЗОВАТЕЛЕЙ:\n\n"
+        report = ReportBuilder()
+        report.add("📋 СПИСОК ПОЛЬЗОВАТЕЛЕЙ:")
+        report.add()
         
         for row in result:
             telegram_id, full_name, role, warehouse_name = row
             role_icon = "👑" if role == 'admin' else "👤"
             warehouse = warehouse_name if warehouse_name else "склад не назначен"
-            response += f"{role_icon} {full_name}\n"
-            response += f"   ID: {telegram_id}\n"
-            response += f"   📦 Склад: {warehouse}\n\n"
+            report.add(f"{role_icon} {full_name}\n"
+                       f"   ID: {telegram_id}\n"
+                       f"   📦 Склад: {warehouse}\n")
         
-        bot.reply_to(message, response)
+        send_report(message, report, filename='пользователи.txt')
         
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {e}")
@@ -1140,107 +2546,27 @@ def users_command(message):
             pass
 # ========== КОМАНДЫ ЭКСПОРТА ==========
 
-@bot.message_handler(commands=['export_today', 'export_day'])
 def export_today_command(message):
     """Экспорт сегодняшних операций"""
-    file_data, message_text = export_transactions_to_excel(message.from_user.id, days=1)
-    
-    if file_data:
-        bot.send_document(message.chat.id, file_data, 
-                         caption=message_text,
-                         visible_file_name=f"операции_за_{datetime.now().strftime('%d.%m.%Y')}.xlsx")
-    else:
-        bot.reply_to(message, message_text)
+    run_export(message, 'transactions', 'операции_за', days=1)
 
-@bot.message_handler(commands=['export_week'])
 def export_week_command(message):
     """Экспорт операций за неделю"""
-    file_data, message_text = export_transactions_to_excel(message.from_user.id, days=7)
-    
-    if file_data:
-        bot.send_document(message.chat.id, file_data,
-                         caption=message_text,
-                         visible_file_name=f"операции_неделя_{datetime.now().strftime('%d.%m.%Y')}.xlsx")
-    else:
-        bot.reply_to(message, message_text)
+    run_export(message, 'transactions', 'операции_неделя', days=7)
 
-@bot.message_handler(commands=['export_month'])
 def export_month_command(message):
     """Экспорт операций за месяц"""
-    file_data, message_text = export_transactions_to_excel(message.from_user.id, days=30)
-    
-    if file_data:
-        bot.send_document(message.chat.id, file_data,
-                         caption=message_text,
-                         visible_file_name=f"операции_месяц_{datetime.now().strftime('%d.%m.%Y')}.xlsx")
-    else:
-        bot.reply_to(message, message_text)
+    run_export(message, 'transactions', 'операции_месяц', days=30)
 
-@bot.message_handler(commands=['export_balances'])
 def export_balances_command(message):
     """Экспорт текущих остатков из таблицы stock"""
-    conn = get_db_connection()
-    if not conn:
-        bot.reply_to(message, "❌ Ошибка подключения к БД")
-        return
-    
-    try:
-        user = get_user_by_telegram_id(message.from_user.id)
-        if not user or user['role'] != 'admin':
-            bot.reply_to(message, "❌ Только для администраторов")
-            return
-        
-        # Получаем остатки из таблицы STOCK (не balances!)
-        result = conn.run("""
-            SELECT 
-                COALESCE(u.full_name, 'Нет пользователя') as пользователь,
-                w.name as склад,
-                p.name as товар,
-                s.quantity as остаток,
-                s.updated_at as обновлено
-            FROM stock s
-            JOIN warehouses w ON s.warehouse_id = w.id
-            JOIN products p ON s.product_id = p.id
-            LEFT JOIN users u ON w.id = u.warehouse_id
-            WHERE s.quantity > 0
-            ORDER BY w.name, p.name
-        """)
-        
-        if not result:
-            bot.reply_to(message, "📊 Нет данных об остатках")
-            return
-        
-        # Создаем Excel
-        df = pd.DataFrame(result, columns=['Пользователь', 'Склад', 'Товар', 'Остаток', 'Обновлено'])
-        
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df.to_excel(writer, sheet_name='Остатки', index=False)
-            
-            # Сводка по складам
-            summary = df.groupby(['Склад', 'Товар'])['Остаток'].sum().reset_index()
-            summary.to_excel(writer, sheet_name='Сводка', index=False)
-        
-        output.seek(0)
-        
-        bot.send_document(message.chat.id, output,
-                         caption=f"✅ Экспортировано {len(df)} записей об остатках",
-                         visible_file_name=f"остатки_{datetime.now().strftime('%d.%m.%Y')}.xlsx")
-        
-    except Exception as e:
-        bot.reply_to(message, f"❌ Ошибка: {e}")
-    finally:
-        try:
-            conn.close()
-        except:
-            pass
-            
+    run_export(message, 'balances', 'остатки')
+
 # ========== Показать все продукты ==========
 
-@bot.message_handler(commands=['products'])
 def products_command(message):
     """Список всех товаров (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -1250,19 +2576,21 @@ def products_command(message):
         bot.reply_to(message, "📦 В системе нет товаров")
         return
     
-    response = "📋 СПИСОК ТОВАРОВ:\n\n"
+    report = ReportBuilder()
+    report.add("📋 СПИСОК ТОВАРОВ:")
+    report.add()
     for product in products:
-        response += f"• ID: {product['id']}, Название: {product['name']}\n"
+        report.add(f"• ID: {product['id']}, Название: {product['name']}")
     
-    response += f"\n📊 Всего товаров: {len(products)}"
-    bot.reply_to(message, response)
+    report.add()
+    report.add(f"📊 Всего товаров: {len(products)}")
+    send_report(message, report, filename='товары.txt')
 
 # ========== Убрать ошибочно созданный продукт ==========
 
-@bot.message_handler(commands=['products1'])
 def products1_command(message):
     """Удалить товар (админ)"""
-    user = get_user_by_telegram_id(message.from_user.id)
+    user = current_user(message)
     if not user or user['role'] != 'admin':
         bot.reply_to(message, "❌ Только для администраторов")
         return
@@ -1333,6 +2661,7 @@ def process_delete_product(message):
         conn.run("DELETE FROM stock WHERE product_id = :id", id=product_id)
         # Затем удаляем сам товар
         conn.run("DELETE FROM products WHERE id = :id", id=product_id)
+        catalog.invalidate()
         
         bot.reply_to(message, f"✅ Товар '{product_name}' успешно удален", 
                     reply_markup=telebot.types.ReplyKeyboardRemove())
@@ -1346,86 +2675,810 @@ def process_delete_product(message):
             pass
 
 
-# ========== СИНОНИМЫ КОМАНД ==========
+# ========== Обновить кэш справочников ==========
 
-@bot.message_handler(commands=['adduser'])
-def adduser_alias_command(message):
-    """Синоним для /add_user (без подчеркивания)"""
-    add_user_command(message)
+def refresh_catalog_command(message):
+    """Принудительно перечитать товары и склады из БД (админ)"""
+    user = current_user(message)
+    if not user or user['role'] != 'admin':
+        bot.reply_to(message, "❌ Только для администраторов")
+        return
+    
+    if not catalog.refresh():
+        bot.reply_to(message, "❌ Ошибка подключения к БД")
+        return
+    
+    bot.reply_to(message, f"🔄 Справочники обновлены: товаров {len(catalog.products)}, "
+                          f"складов {len(catalog.warehouses)}")
 
-@bot.message_handler(commands=['addproduct'])
-def addproduct_alias_command(message):
-    """Синоним для /add_product (без подчеркивания)"""
-    add_product_command(message)
 
-@bot.message_handler(commands=['addwarehouse'])
-def addwarehouse_alias_command(message):
-    """Синоним для /add_warehouse (без подчеркивания)"""
-    add_warehouse_command(message)
+# ========== Итоги за период ==========
 
-@bot.message_handler(commands=['allbalance'])
-def allbalance_alias_command(message):
-    """Синоним для /all_balance (без подчеркивания)"""
-    all_balance_command(message)
-# ========== ОБРАБОТКА КНОПОК ==========
-@bot.message_handler(func=lambda message: True)
-def handle_buttons(message):
-    """Обработка нажатий на кнопки и текстовых сообщений"""
+def totals_command(message):
+    """Приход и расход по товарам за N дней: /totals 7 (из дневной сводки)"""
+    user = current_user(message)
+    if not user:
+        bot.reply_to(message, "❌ Вы не зарегистрированы в системе")
+        return
     
-    # Если сообщение пустое - пропускаем
-    if not message.text:
+    parts = (message.text or '').split()
+    try:
+        days = int(parts[1]) if len(parts) > 1 else 30
+        if days <= 0:
+            raise ValueError
+    except ValueError:
+        bot.reply_to(message, "❌ Укажите число дней: /totals 7")
         return
     
-    # Если это команда (начинается с /) - ПРОПУСКАЕМ
-    if message.text.startswith('/'):
+    # Админ видит все склады, пользователь - только свой
+    warehouse_id = None
+    if user['role'] != 'admin':
+        warehouse_id = user['warehouse_id']
+        if not warehouse_id:
+            bot.reply_to(message, "❌ Склад не назначен")
+            return
+    
+    conn = get_db_connection()
+    if not conn:
+        bot.reply_to(message, "❌ Ошибка подключения к БД")
         return
     
-    user = get_user_by_telegram_id(message.from_user.id)
-    if not user:
-        bot.reply_to(message, "Сначала /start")
+    try:
+        start_date = (datetime.now() - timedelta(days=days)).date()
+        result = period_totals(conn, start_date, warehouse_id)
+        if not result:
+            bot.reply_to(message, f"📊 Нет операций за последние {days} дней")
+            return
+        
+        report = ReportBuilder()
+        report.add(f"📊 *ИТОГИ С {start_date.strftime('%d.%m.%Y')}:*")
+        current_type = None
+        for transaction_type, product_name, quantity, operations in result:
+            if transaction_type != current_type:
+                report.add()
+                report.add(f"*{transaction_type}:*")
+                current_type = transaction_type
+            report.add(f"  • {escape_md(product_name)}: {quantity} л. ({operations} оп.)")
+        
+        send_report(message, report, parse_mode='Markdown', filename='итоги.txt')
+        
+    except Exception as e:
+        bot.reply_to(message, f"❌ Ошибка: {e}")
+    finally:
+        try:
+            conn.close()
+        except:
+            pass
+
+
+def rebuild_rollup_command(message):
+    """Пересчитать дневную сводку из журнала операций (админ)"""
+    user = current_user(message)
+    if not user or user['role'] != 'admin':
+        bot.reply_to(message, "❌ Только для администраторов")
+        return
+    
+    conn = get_db_connection()
+    if not conn:
+        bot.reply_to(message, "❌ Ошибка подключения к БД")
+        return
+    
+    try:
+        count = rebuild_rollup(conn)
+        bot.reply_to(message, f"✅ Дневная сводка пересчитана: {count} строк")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Ошибка: {e}")
+    finally:
+        conn.close()
+
+
+# ========== МАССОВОЕ ПОПОЛНЕНИЕ ИЗ ФАЙЛА ==========
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 5 * 1024 * 1024))
+# Сколько отклоненных строк перечислять в ответе
+IMPORT_REJECTED_SHOWN = 50
+
+
+@bot.message_handler(content_types=['document'])
+def import_document(message):
+    """Пополнение остатков файлом .xlsx/.csv: склад, товар, количество (админ)"""
+    set_log_fields(handler='import_document')
+    user = current_user(message)
+    if not user or user['role'] != 'admin':
+        bot.reply_to(message, "❌ Загрузка файлов доступна только администраторам")
+        return
+    
+    document = message.document
+    filename = document.file_name or ''
+    if not filename.lower().endswith(('.xlsx', '.csv')):
+        bot.reply_to(message, "❌ Пришлите файл .xlsx или .csv с колонками: склад, товар, количество")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        bot.reply_to(message, f"❌ Файл больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ")
+        return
+    
+    try:
+        data = bot.download_file(bot.get_file(document.file_id).file_path)
+    except Exception as e:
+        bot.reply_to(message, f"❌ Не удалось скачать файл: {e}")
+        return
+    
+    if not catalog.ensure_fresh():
+        bot.reply_to(message, "❌ Ошибка подключения к БД")
+        return
+    
+    try:
+        accepted, rejected = stock_import.parse_movements(
+            stock_import.read_rows(data, filename),
+            catalog.warehouse_ids, catalog.warehouse_names,
+            catalog.product_ids, catalog.product_names,
+        )
+    except Exception as e:
+        bot.reply_to(message, f"❌ Не удалось прочитать файл: {e}")
         return
     
+    if not accepted:
+        report = ReportBuilder()
+        report.add("❌ В файле нет строк для пополнения")
+    else:
+        conn = get_db_connection()
+        if not conn:
+            bot.reply_to(message, "❌ Ошибка подключения к БД")
+            return
+        try:
+            balances = receive_stock_batch(conn, [row[1:] for row in accepted], user_id=user['id'])
+        except Exception as e:
+            bot.reply_to(message, f"❌ Ошибка, остатки не изменены: {e}")
+            return
+        finally:
+            conn.close()
+        
+        report = ReportBuilder()
+        report.add(f"✅ Принято строк: {len(accepted)}, "
+                   f"всего {sum(row[3] for row in accepted)} л.")
+        report.add(f"📦 Обновлено позиций на складах: {len(balances)}")
+        per_warehouse = {}
+        for warehouse_id, _, _ in balances:
+            per_warehouse[warehouse_id] = per_warehouse.get(warehouse_id, 0) + 1
+        for warehouse_id, count in per_warehouse.items():
+            report.add(f"  🏢 {catalog.warehouse_names.get(warehouse_id, warehouse_id)}: {count} поз.")
+    
+    if rejected:
+        report.add()
+        report.add(f"⚠️ Отклонено строк: {len(rejected)}")
+        for line, reason in rejected[:IMPORT_REJECTED_SHOWN]:
+            report.add(f"  строка {line}: {reason}")
+        if len(rejected) > IMPORT_REJECTED_SHOWN:
+            report.add(f"  ... и еще {len(rejected) - IMPORT_REJECTED_SHOWN}")
+    
+    send_report(message, report, filename='загрузка.txt')
+
+
+# ========== РЕЕСТР КОМАНД ==========
+# Каждая команда описана один раз: имена (первое - основное, остальные -
+# синонимы), кнопка меню и ее ряд, кому доступна, обработчик и строка справки.
+# Из реестра один раз при запуске строятся таблицы поиска по имени и по
+# тексту кнопки, клавиатуры и тексты /start для каждой роли.
+ROLE_ADMIN = 'admin'
+ROLE_USER = 'user'
+
+Command = namedtuple('Command', 'names button row role handler help')
+
+COMMANDS = [
+    Command(('start', 'help'), None, None, None, start, None),
+    Command(('balance',), '📊 Мои остатки', 0, None, balance, "📊 /balance - Мои остатки"),
+    Command(('spend',), '📤 Списать', 0, None, spend_command,
+            "📤 /spend - Списать товар\n"
+            "📤 /spend 3:5 мерло:2.5 - Списать сразу несколько (админ: @ID склада в начале)"),
+    Command(('totals',), None, None, None, totals_command,
+            "📈 /totals - Итоги за 30 дней (/totals 7 - за неделю)"),
+    Command(('add_product', 'addproduct'), '➕ Товар', 1, ROLE_ADMIN, add_product_command,
+            "➕ /add_product - Добавить товар"),
+    Command(('products1',), '🗑️ Удалить товар', 1, ROLE_ADMIN, products1_command,
+            "🗑️ /products1 - Удалить товар"),
+    Command(('products',), '📋 Товары', 1, ROLE_ADMIN, products_command, "📋 /products - Список товаров"),
+    Command(('add_warehouse', 'addwarehouse'), '🏢 Склад', 2, ROLE_ADMIN, add_warehouse_command,
+            "🏢 /add_warehouse - Добавить склад"),
+    Command(('add_user', 'adduser'), '👤 Пользователь', 2, ROLE_ADMIN, add_user_command,
+            "👤 /add_user - Добавить пользователя"),
+    Command(('all_balance', 'allbalance'), '📦 Все остатки', 2, ROLE_ADMIN, all_balance_command,
+            "📦 /all_balance - Все остатки"),
+    Command(('warehouses',), '📋 Список складов', 3, ROLE_ADMIN, warehouses_command,
+            "📋 /warehouses - Список складов"),
+    Command(('users',), '👥 Список пользователей', 3, ROLE_ADMIN, users_command,
+            "👥 /users - Список пользователей"),
+    Command(('add',), '🔄 Пополнить', 3, ROLE_ADMIN, add_stock_command,
+            "🔄 /add - Пополнить остатки (/add @ID склада 3:5 - списком)\n"
+            "📥 Файл .xlsx/.csv (склад, товар, количество) - массовое пополнение"),
+    Command(('export_today', 'export_day'), '📤 Экспорт дня', 4, ROLE_ADMIN, export_today_command,
+            "📤 /export_today - Операции за день"),
+    Command(('export_week',), '📤 Экспорт недели', 4, ROLE_ADMIN, export_week_command,
+            "📤 /export_week - Операции за неделю"),
+    Command(('export_month',), '📤 Экспорт месяца', 4, ROLE_ADMIN, export_month_command,
+            "📤 /export_month - Операции за месяц"),
+    Command(('export_balances',), '📊 Экспорт остатков', 5, ROLE_ADMIN, export_balances_command,
+            "📊 /export_balances - Текущие остатки\n"
+            "   (к экспорту можно добавить формат: csv или parquet)"),
+    Command(('rebuild_rollup',), None, None, ROLE_ADMIN, rebuild_rollup_command,
+            "🔄 /rebuild_rollup - Пересчитать дневную сводку"),
+    Command(('refresh_catalog',), None, None, ROLE_ADMIN, refresh_catalog_command,
+            "🔄 /refresh_catalog - Обновить справочники"),
+]
+
+
+def build_command_index(commands):
+    """Таблицы поиска: имя команды -> Command и текст кнопки -> Command"""
+    by_name = {}
+    by_button = {}
+    for command in commands:
+        for name in command.names:
+            if name in by_name:
+                raise ValueError(f"Команда /{name} описана дважды")
+            by_name[name] = command
+        if command.button:
+            if command.button in by_button:
+                raise ValueError(f"Кнопка '{command.button}' описана дважды")
+            by_button[command.button] = command
+    return by_name, by_button
+
+
+def allowed(command, role):
+    return command.role is None or command.role == role
+
+
+def build_menu(commands, role):
+    """Клавиатура роли: кнопки доступных команд по рядам"""
+    rows = {}
+    for command in commands:
+        if command.button and allowed(command, role):
+            rows.setdefault(command.row, []).append(command.button)
+    markup = telebot.types.ReplyKeyboardMarkup(resize_keyboard=True)
+    for row in sorted(rows):
+        markup.row(*rows[row])
+    return markup
+
+
+def build_help(commands, role):
+    """Список команд роли для /start (Markdown)"""
+    lines = [escape_md(command.help) for command in commands
+             if command.help and allowed(command, role)]
+    text = '\n'.join(lines)
+    if role == ROLE_ADMIN:
+        text = "*📋 Все команды:*\n\n" + text
+    return text
+
+
+COMMANDS_BY_NAME, COMMANDS_BY_BUTTON = build_command_index(COMMANDS)
+MENUS = {role: build_menu(COMMANDS, role) for role in (ROLE_ADMIN, ROLE_USER)}
+HELP_TEXTS = {role: build_help(COMMANDS, role) for role in (ROLE_ADMIN, ROLE_USER)}
+
+GREETINGS = frozenset(['привет', 'hello', 'hi', 'здравствуй'])
+HELP_WORDS = frozenset(['помощь', 'help', 'справка'])
+
+
+def command_name(text):
+    """"/export_week@wine_bot csv" -> "export_week" """
+    return text.split(maxsplit=1)[0][1:].split('@', 1)[0].lower()
+
+
+@bot.message_handler(content_types=['text'])
+def route_message(message):
+    """Все текстовые сообщения: команда или кнопка ищется в реестре за O(1)"""
     text = message.text
+    if not text:
+        return
+    set_log_fields(handler='route_message')
+    
+    if text.startswith('/'):
+        command = COMMANDS_BY_NAME.get(command_name(text))
+        if command is None:
+            bot.reply_to(message, "Не понимаю команду. /start - для списка команд.")
+            return
+    else:
+        command = COMMANDS_BY_BUTTON.get(text)
+    
+    if command is not None:
+        set_log_fields(handler=command.handler.__name__)
+        if command.role is not None:
+            user = current_user(message)
+            if not user or user['role'] != command.role:
+                bot.reply_to(message, "❌ Только для администраторов")
+                return
+        command.handler(message)
+        return
+    
+    # Обычный текст
+    user = current_user(message)
+    if not user:
+        bot.reply_to(message, "Сначала /start")
+        return
     
-    # Обработка кнопок
-    if text == '📊 Мои остатки':
-        balance(message)
-    elif text == '📤 Списать':
-        spend_command(message)
-    elif text == '📦 Все остатки' and user['role'] == 'admin':
-        all_balance_command(message)
-    elif text == '➕ Товар' and user['role'] == 'admin':
-        add_product_command(message)
-    elif text == '📋 Товары' and user['role'] == 'admin':
-        products_command(message)
-    elif text == '🗑️ Удалить товар' and user['role'] == 'admin':
-        products1_command(message)
-    elif text == '🏢 Склад' and user['role'] == 'admin':
-        add_warehouse_command(message)
-    elif text == '👤 Пользователь' and user['role'] == 'admin':
-        add_user_command(message)
-    elif text == '📋 Список складов' and user['role'] == 'admin':
-        warehouses_command(message)
-    elif text == '👥 Список пользователей' and user['role'] == 'admin':
-        users_command(message)
-    elif text == '🔄 Пополнить остатки' and user['role'] == 'admin':
-        add_stock_command(message)
-    elif text == '📤 Экспорт дня' and user['role'] == 'admin':
-        export_today_command(message)
-    elif text == '📤 Экспорт недели' and user['role'] == 'admin':
-        export_week_command(message)
-    elif text == '📤 Экспорт месяца' and user['role'] == 'admin':
-        export_month_command(message)
-    elif text == '📊 Экспорт остатков' and user['role'] == 'admin':
-        export_balances_command(message)
+    word = text.strip().lower()
+    if word in GREETINGS:
+        bot.reply_to(message, f"Привет, {user['full_name']}! 👋\nИспользуйте кнопки или команды.")
+    elif word in HELP_WORDS:
+        bot.reply_to(message, "Используйте кнопки или команды из меню. /start - для списка команд.")
     else:
-        # Обработка обычного текста
-        if text.lower() in ['привет', 'hello', 'hi', 'здравствуй']:
-            bot.reply_to(message, f"Привет, {user['full_name']}! 👋\nИспользуйте кнопки или команды.")
-        elif text.lower() in ['помощь', 'help', 'справка']:
-            bot.reply_to(message, "Используйте кнопки или команды из меню. /start - для списка команд.")
+        bot.reply_to(message, "Не понимаю команду. Используйте кнопки ниже или команды из меню.\n/start - для помощи.")
+
+# ========== ОЧЕРЕДЬ ОБНОВЛЕНИЙ ==========
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 4))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 1000))
+UPDATE_ENQUEUE_TIMEOUT = float(os.environ.get('UPDATE_ENQUEUE_TIMEOUT', 0.5))
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+
+
+def update_chat_id(update):
+    """Чат, к которому относится обновление (для упорядочивания)"""
+    for kind in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        message = getattr(update, kind, None)
+        if message is not None:
+            return message.chat.id
+    call = update.callback_query
+    if call is not None:
+        return call.message.chat.id if call.message else call.from_user.id
+    for kind in ('inline_query', 'chosen_inline_result', 'shipping_query',
+                 'pre_checkout_query', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        event = getattr(update, kind, None)
+        if event is not None:
+            chat = getattr(event, 'chat', None)
+            return chat.id if chat is not None else event.from_user.id
+    return update.update_id
+
+
+class UpdateDispatcher:
+    """Ограниченные очереди входящих обновлений с рабочими потоками
+
+    Вебхук только кладет обновление в очередь и сразу отвечает Telegram,
+    а обработчики (запросы к БД, ответы пользователю) выполняются в потоках.
+
+    Обновления раскладываются по "полосам" по chat_id: у каждой полосы своя
+    очередь и один поток. Сообщения одного чата (шаги диалога /spend, /add,
+    /add_user) обрабатываются строго по порядку, а разные чаты - параллельно.
+    """
+
+    def __init__(self, process, workers=4, queue_size=1000, ready=None):
+        self._process = process
+        self._ready = ready  # threading.Event: до него обновления только копятся в очередях
+        self.workers = max(workers, 1)
+        lane_size = max(queue_size // self.workers, 1)
+        self._lanes = [queue.Queue(maxsize=lane_size) for _ in range(self.workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = {
+            'submitted': 0,
+            'rejected': 0,
+            'processed': 0,
+            'failed': 0,
+        }
+        self._busy = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def start(self):
+        """Запустить рабочие потоки (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._threads:
+                return
+            for i, lane in enumerate(self._lanes):
+                thread = threading.Thread(target=self._work, args=(lane,), name=f'update-lane-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def lane_for(self, update):
+        return self._lanes[hash(update_chat_id(update)) % self.workers]
+
+    def submit(self, update, timeout=0, retrying=False):
+        """Поставить обновление в очередь его чата. False - очередь переполнена
+
+        retrying=True - вызывающий повторит попытку сам, поэтому переполнение
+        не считается отказом (rejected).
+        """
+        self.start()
+        try:
+            self.lane_for(update).put((update, time.monotonic()), timeout=timeout)
+        except queue.Full:
+            if not retrying:
+                with self._lock:
+                    self._counters['rejected'] += 1
+            return False
+        with self._lock:
+            self._counters['submitted'] += 1
+        return True
+
+    def _work(self, lane):
+        if self._ready is not None:
+            self._ready.wait()
+        while True:
+            update, enqueued_at = lane.get()
+            waited = time.monotonic() - enqueued_at
+            with self._lock:
+                self._busy += 1
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            # Поля попадут во все записи лога, сделанные обработчиками этого обновления
+            log_context.fields = {'update_id': update.update_id, 'chat_id': update_chat_id(update)}
+            started = time.perf_counter()
+            try:
+                self._process([update])
+                outcome = 'processed'
+            except Exception as e:
+                log.error("❌ Update error", exc_info=e)
+                outcome = 'failed'
+            finally:
+                elapsed = time.perf_counter() - started
+                handler = (log_context.fields or {}).get('handler', 'other')
+                HANDLER_DURATION.observe(elapsed, handler)
+                HANDLER_REQUESTS.inc(handler, outcome)
+                duration_ms = round(elapsed * 1000, 1)
+                if duration_ms >= LOG_SLOW_UPDATE_MS:
+                    log.warning("🐢 Slow update", extra=kv(duration_ms=duration_ms, outcome=outcome))
+                else:
+                    debug_sampled("update handled", duration_ms=duration_ms, outcome=outcome)
+                log_context.fields = None
+                with self._lock:
+                    self._busy -= 1
+                    self._counters[outcome] += 1
+                lane.task_done()
+
+    def stats(self):
+        with self._lock:
+            done = self._counters['processed'] + self._counters['failed']
+            return {
+                'workers': self.workers,
+                'busy': self._busy,
+                'queue_depth': sum(lane.qsize() for lane in self._lanes),
+                'queue_capacity': sum(lane.maxsize for lane in self._lanes),
+                'lane_depths': [lane.qsize() for lane in self._lanes],
+                'avg_wait_ms': round(self._wait_total / done * 1000, 2) if done else 0.0,
+                'max_wait_ms': round(self._wait_max * 1000, 2),
+                'ready': self._ready is None or self._ready.is_set(),
+                **self._counters,
+            }
+
+
+dispatcher = UpdateDispatcher(bot.process_new_updates, workers=UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE,
+                              ready=schema_ready)
+
+# ========== ИСХОДЯЩИЕ СООБЩЕНИЯ ==========
+TELEGRAM_GLOBAL_RATE = float(os.environ.get('TELEGRAM_GLOBAL_RATE', 30))
+TELEGRAM_CHAT_RATE = float(os.environ.get('TELEGRAM_CHAT_RATE', 1))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', 3))
+TELEGRAM_MAX_RETRIES = int(os.environ.get('TELEGRAM_MAX_RETRIES', 3))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Тяжелые отправки (файлы) пропускают вперед ответы на нажатия кнопок
+BULK_METHODS = {'sendDocument', 'sendPhoto', 'sendVideo', 'sendAudio', 'sendMediaGroup'}
+RATE_LIMITED_PREFIXES = ('send', 'edit', 'copyMessage', 'forwardMessage')
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Сколько ждать до свободного токена (0 - можно сейчас)"""
+        self._refill(now)
+        pause = max(self.paused_until - now, 0.0)
+        if self.tokens >= 1:
+            return pause
+        return max(pause, (1 - self.tokens) / self.rate)
+
+    def reserve(self, now):
+        """Занять токен, даже в долг; вернуть, сколько ждать своей очереди"""
+        wait = self.delay(now)
+        self.tokens -= 1
+        return wait
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class OutboundScheduler:
+    """Ограничение скорости исходящих запросов к Telegram
+
+    Общий лимит (TELEGRAM_GLOBAL_RATE в секунду) и лимит на чат
+    (TELEGRAM_CHAT_RATE). Когда запросов больше, чем позволяет общий лимит,
+    первыми проходят интерактивные ответы, а документы ждут.
+    """
+
+    MAX_CHATS = 10000
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = OrderedDict()  # chat_id -> TokenBucket
+        self._waiting = []           # куча (приоритет, номер) ожидающих общий токен
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stats = {
+            priority: {'requests': 0, 'delayed': 0, 'wait_total': 0.0, 'wait_max': 0.0}
+            for priority in (PRIORITY_INTERACTIVE, PRIORITY_BULK)
+        }
+        self.rate_limited = 0
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            while len(self._chats) > self.MAX_CHATS:
+                self._chats.popitem(last=False)
         else:
-            bot.reply_to(message, "Не понимаю команду. Используйте кнопки ниже или команды из меню.\n/start - для помощи.")
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def acquire(self, chat_id, priority=PRIORITY_INTERACTIVE):
+        """Дождаться разрешения на запрос в чат chat_id"""
+        started = time.monotonic()
+        
+        # 1. Лимит чата: занимаем слот и спим вне блокировки, не мешая другим чатам
+        if chat_id is not None:
+            with self._cond:
+                wait = self._chat_bucket(chat_id).reserve(time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+        
+        # 2. Общий лимит: токен получает только голова очереди по приоритету
+        entry = (priority, next(self._seq))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._global.delay(now)
+                    if self._waiting[0] == entry and wait <= 0:
+                        self._global.take(now)
+                        break
+                    self._cond.wait(wait if self._waiting[0] == entry else None)
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+            
+            waited = time.monotonic() - started
+            stats = self._stats[priority]
+            stats['requests'] += 1
+            stats['delayed'] += waited > 0.001
+            stats['wait_total'] += waited
+            stats['wait_max'] = max(stats['wait_max'], waited)
+
+    def backoff(self, chat_id, retry_after, limited=True):
+        """Telegram ответил 429: не шлем в этот чат (или никуда) retry_after секунд
+
+        limited=False - метод не проходит через ведра (getFile,
+        answerCallbackQuery): 429 только учитывается, а ждет сам вызывающий.
+        Иначе такой ответ остановил бы все исходящие сообщения.
+        """
+        with self._cond:
+            self.rate_limited += 1
+            if not limited:
+                return
+            until = time.monotonic() + retry_after
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else self._global
+            bucket.paused_until = max(bucket.paused_until, until)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            result = {
+                'waiting': len(self._waiting),
+                'chats_tracked': len(self._chats),
+                'rate_limited': self.rate_limited,
+            }
+            for priority, name in ((PRIORITY_INTERACTIVE, 'interactive'), (PRIORITY_BULK, 'bulk')):
+                stats = self._stats[priority]
+                requests_count = stats['requests']
+                result[name] = {
+                    'requests': requests_count,
+                    'delayed': stats['delayed'],
+                    'avg_wait_ms': round(stats['wait_total'] / requests_count * 1000, 2) if requests_count else 0.0,
+                    'max_wait_ms': round(stats['wait_max'] * 1000, 2),
+                }
+            return result
+
+
+outbound = OutboundScheduler(TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+_http = threading.local()
+
+
+def _http_session():
+    session = getattr(_http, 'session', None)
+    if session is None:
+        session = _http.session = requests.Session()
+    return session
+
+
+def _retry_after(response):
+    try:
+        return float(response.json()['parameters']['retry_after'])
+    except Exception:
+        return 1.0
+
+
+def _rewind_files(files):
+    """Перед повторной отправкой файлы нужно читать с начала"""
+    for value in (files or {}).values():
+        fileobj = value[1] if isinstance(value, tuple) else value
+        if hasattr(fileobj, 'seek'):
+            fileobj.seek(0)
+
+
+def scheduled_request_sender(method, url, params=None, files=None, timeout=None, proxies=None):
+    """Все запросы telebot к Bot API идут через этот отправитель
+
+    Отправки сообщений ждут токены OutboundScheduler, а ответ 429
+    (flood control) выдерживает паузу retry_after и повторяется.
+    """
+    method_name = url.rsplit('/', 1)[-1]
+    limited = method_name.startswith(RATE_LIMITED_PREFIXES)
+    priority = PRIORITY_BULK if method_name in BULK_METHODS else PRIORITY_INTERACTIVE
+    chat_id = (params or {}).get('chat_id')
+    
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        if limited:
+            outbound.acquire(chat_id, priority)
+        if attempt:
+            _rewind_files(files)
+        started = time.perf_counter()
+        try:
+            response = _http_session().request(method, url, params=params, files=files,
+                                               timeout=timeout, proxies=proxies)
+        except Exception:
+            TELEGRAM_REQUESTS.inc(method_name, 'exception')
+            raise
+        finally:
+            TELEGRAM_DURATION.observe(time.perf_counter() - started, method_name)
+        TELEGRAM_REQUESTS.inc(method_name, str(response.status_code))
+        if response.status_code != 429 or attempt == TELEGRAM_MAX_RETRIES:
+            return response
+        
+        retry_after = _retry_after(response)
+        log.warning("⚠️ Telegram 429", extra=kv(method=method_name, chat_id=chat_id, retry_after=retry_after))
+        outbound.backoff(chat_id, retry_after, limited)
+        if not limited:
+            time.sleep(retry_after)
+
+
+apihelper.CUSTOM_REQUEST_SENDER = scheduled_request_sender
+
+# ========== РЕЖИМ LONG POLLING ==========
+BOT_MODE = os.environ.get('BOT_MODE', 'webhook')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', 'https://wine-telegram-bot.onrender.com/webhook')
+POLLING_OFFSET_FILE = os.environ.get('POLLING_OFFSET_FILE', 'polling_offset.json')
+POLLING_BATCH_SIZE = int(os.environ.get('POLLING_BATCH_SIZE', 100))
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', 25))
+POLLING_REPORT_INTERVAL = float(os.environ.get('POLLING_REPORT_INTERVAL', 60))
+
+
+class OffsetStore:
+    """Смещение getUpdates в файле - после перезапуска продолжаем с того же места"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)['offset']
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.warning(f"⚠️ Polling offset file is unreadable: {e}")
+            return None
+
+    def save(self, offset):
+        # Пишем во временный файл и подменяем - файл не бывает "наполовину записан"
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'offset': offset}, f)
+        os.replace(tmp_path, self.path)
+
+
+class PollingRunner:
+    """Получение обновлений через getUpdates пачками
+
+    Пачка раскладывается по тем же полосам UpdateDispatcher, что и в режиме
+    вебхука, так что обработчики и порядок внутри чата одинаковые. Смещение
+    сохраняется после постановки пачки в очередь: при падении процесса
+    обновления, стоявшие в очереди, Telegram повторно не пришлет.
+    """
+
+    def __init__(self, bot, dispatcher, offset_store, batch_size=100, timeout=25,
+                 report_interval=60):
+        self.bot = bot
+        self.dispatcher = dispatcher
+        self.offset_store = offset_store
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.offset = None
+        self.received = 0
+        self.batches = 0
+        self.errors = 0
+        self.started_at = None
+        self._recent = deque()  # (время, размер пачки) за последнюю минуту
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        self.bot.remove_webhook()
+        self.offset = self.offset_store.load()
+        self.started_at = time.monotonic()
+        last_report = self.started_at
+        backoff = 1
+        log.info(f"🔄 Polling started (offset={self.offset})")
+        
+        while not self._stopped.is_set():
+            try:
+                updates = self.bot.get_updates(offset=self.offset, limit=self.batch_size,
+                                               timeout=self.timeout + 10,
+                                               long_polling_timeout=self.timeout)
+                backoff = 1
+            except Exception as e:
+                self.errors += 1
+                log.error(f"❌ getUpdates error: {e}")
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, 30)
+                continue
+            
+            if updates:
+                for update in updates:
+                    # Очереди заполнены - ждем, а не теряем обновление
+                    while not self.dispatcher.submit(update, timeout=1, retrying=True):
+                        if self._stopped.is_set():
+                            return
+                    self.offset = update.update_id + 1
+                self.offset_store.save(self.offset)
+                self._record(len(updates))
+            
+            if time.monotonic() - last_report >= self.report_interval:
+                last_report = time.monotonic()
+                stats = self.stats()
+                log.info("📈 Polling", extra=kv(received=stats['received'],
+                                               updates_per_sec=stats['updates_per_sec'],
+                                               updates_per_sec_total=stats['updates_per_sec_total']))
+
+    def _record(self, count):
+        now = time.monotonic()
+        self.received += count
+        self.batches += 1
+        self._recent.append((now, count))
+        while self._recent and now - self._recent[0][0] > 60:
+            self._recent.popleft()
+
+    def stats(self):
+        now = time.monotonic()
+        elapsed = now - self.started_at if self.started_at else 0
+        recent = sum(count for at, count in list(self._recent) if now - at <= 60)
+        return {
+            'offset': self.offset,
+            'received': self.received,
+            'batches': self.batches,
+            'errors': self.errors,
+            'updates_per_sec': round(recent / min(max(elapsed, 1), 60), 2),
+            'updates_per_sec_total': round(self.received / elapsed, 2) if elapsed else 0.0,
+        }
+
+
+polling_runner = PollingRunner(bot, dispatcher, OffsetStore(POLLING_OFFSET_FILE),
+                               batch_size=POLLING_BATCH_SIZE, timeout=POLLING_TIMEOUT,
+                               report_interval=POLLING_REPORT_INTERVAL)
 
 # ========== WEBHOOK И ЗАПУСК ==========
 @app.route('/')
@@ -1438,45 +3491,154 @@ def health_check():
     """Для UptimeRobot"""
     return 'OK!', 200
 
+@app.route('/stats')
+def stats():
+    """Внутренняя статистика (размер пула и т.п.)"""
+    return jsonify({
+        'db_pool': db_pool.stats(),
+        'user_cache': user_cache.stats(),
+        'catalog': catalog.stats(),
+        'export_cache': export_cache.stats(),
+        'updates': dispatcher.stats(),
+        'conversation_state': bot.next_step_backend.store.stats(),
+        'polling': polling_runner.stats() if polling_runner.started_at else None,
+        'outbound': outbound.stats(),
+        'startup': startup.as_dict(),
+    }), 200
+
+@metrics.collector
+def runtime_metrics():
+    """Значения, которые уже считают пул, очередь обновлений и кэши"""
+    pool = db_pool.stats()
+    updates = dispatcher.stats()
+    caches = {'user': user_cache.stats(), 'export': export_cache.stats(), 'inline_flow': completed_flows.stats()}
+
+    def per_cache(key):
+        return [({'cache': name}, cache_stats[key]) for name, cache_stats in caches.items()]
+
+    return [
+        ('bot_db_pool_connections', 'gauge', 'Подключения пула',
+         [({'state': 'idle'}, pool['idle']), ({'state': 'in_use'}, pool['in_use'])]),
+        ('bot_db_pool_checkouts_total', 'counter', 'Выдачи подключений из пула', [({}, pool['checkouts'])]),
+        ('bot_db_pool_timeouts_total', 'counter', 'Таймауты ожидания подключения', [({}, pool['timeouts'])]),
+        ('bot_update_queue_depth', 'gauge', 'Обновлений в очереди', [({}, updates['queue_depth'])]),
+        ('bot_update_queue_capacity', 'gauge', 'Емкость очереди обновлений', [({}, updates['queue_capacity'])]),
+        ('bot_update_workers_busy', 'gauge', 'Занятые рабочие потоки', [({}, updates['busy'])]),
+        ('bot_updates_total', 'counter', 'Обновления по результату',
+         [({'outcome': outcome}, updates[outcome]) for outcome in ('submitted', 'rejected', 'processed', 'failed')]),
+        ('bot_cache_hits_total', 'counter', 'Попадания в кэш', per_cache('hits')),
+        ('bot_cache_misses_total', 'counter', 'Промахи кэша', per_cache('misses')),
+        ('bot_cache_hit_ratio', 'gauge', 'Доля попаданий в кэш', per_cache('hit_ratio')),
+        ('bot_cache_entries', 'gauge', 'Записей в кэше', per_cache('size')),
+        ('bot_telegram_rate_limited_total', 'counter', 'Ответы 429 от Telegram',
+         [({}, outbound.stats()['rate_limited'])]),
+    ]
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus"""
+    return Response(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/webhook', methods=['POST', 'GET'])
 def webhook():
     """Обработчик вебхука от Telegram"""
     if request.method == 'GET':
         return 'Webhook is active!', 200
     
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return 'forbidden', 403
+    
     try:
         json_str = request.get_data().decode('UTF-8')
         update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
-        return 'ok', 200
     except Exception as e:
-        print(f"❌ Webhook error: {e}", file=sys.stderr)
-        return 'error', 500
+        log.error(f"❌ Webhook error: {e}")
+        return 'bad request', 400
+    
+    if update is None:
+        return 'bad request', 400
+    
+    # Очередь переполнена - отвечаем ошибкой, Telegram доставит обновление позже
+    if not dispatcher.submit(update, timeout=UPDATE_ENQUEUE_TIMEOUT):
+        log.warning(f"⚠️ Update queue is full, rejecting update {update.update_id}")
+        return 'busy', 503
+    
+    return 'ok', 200
 
-if __name__ == '__main__':
-    # Тест подключения к БД
-    print("🔍 Testing database...", file=sys.stderr)
+def warm_up_database():
+    """Открыть подключения пула, проверить БД и довести схему до нужной коду"""
+    log.info("🔍 Testing database...")
+    try:
+        db_pool.warm()
+    except Exception as e:
+        log.warning(f"⚠️ DB pool warm-up warning: {e}")
     conn = get_db_connection()
     if conn:
         try:
             result = conn.run("SELECT version()")
-            print(f"✅ Database: {result[0][0][:50]}...", file=sys.stderr)
-            conn.close()
+            log.info(f"✅ Database: {result[0][0][:50]}...")
         except Exception as e:
-            print(f"⚠️ Database test warning: {e}", file=sys.stderr)
-    
-    # Настройка вебхука
+            log.warning(f"⚠️ Database test warning: {e}")
+        finally:
+            conn.close()
+    if DB_MIGRATE_ON_START:
+        apply_migrations()
+
+
+def setup_webhook():
+    """Зарегистрировать вебхук (set_webhook сам заменяет старый адрес)"""
     try:
-        bot.remove_webhook()
-        time.sleep(1)
-        
-        webhook_url = f"https://wine-telegram-bot.onrender.com/webhook"
-        bot.set_webhook(url=webhook_url)
-        print(f"✅ Webhook установлен: {webhook_url}", file=sys.stderr)
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
+        log.info(f"✅ Webhook установлен: {WEBHOOK_URL}")
     except Exception as e:
-        print(f"❌ Webhook setup error: {e}", file=sys.stderr)
+        log.error(f"❌ Webhook setup error: {e}")
+
+
+def run_startup_tasks(tasks):
+    """Выполнить этапы запуска параллельно в фоне и напечатать профиль, когда все закончатся
+
+    Сервер начинает слушать порт сразу, не дожидаясь БД и Telegram.
+    """
+    def timed(name, task):
+        with startup.phase(name):
+            task()
     
-    # Запуск Flask
+    threads = [threading.Thread(target=timed, args=(name, task), name=f'startup-{name}', daemon=True)
+               for name, task in tasks]
+    for thread in threads:
+        thread.start()
+    
+    def report():
+        for thread in threads:
+            thread.join()
+        log.info(startup.report())
+    
+    threading.Thread(target=report, name='startup-report', daemon=True).start()
+
+
+startup.add('module load', time.perf_counter() - BOOT_STARTED)
+
+if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
-    print(f"🌐 Starting Flask server on port {port}...", file=sys.stderr)
+    polling = BOT_MODE == 'polling' or '--polling' in sys.argv
+    
+    tasks = [('database', warm_up_database)]
+    if not polling:
+        tasks.append(('webhook', setup_webhook))
+    run_startup_tasks(tasks)
+    
+    if polling:
+        # Без публичного адреса: Flask (/health, /stats) в фоне, getUpdates в основном потоке
+        log.info(f"🌐 Starting Flask server on port {port} (polling mode)...")
+        threading.Thread(target=app.run, kwargs={'host': '0.0.0.0', 'port': port},
+                         name='flask', daemon=True).start()
+        try:
+            polling_runner.run()
+        except KeyboardInterrupt:
+            polling_runner.stop()
+        sys.exit(0)
+    
+    # Запуск Flask
+    log.info(f"🌐 Starting Flask server on port {port}...")
     app.run(host='0.0.0.0', port=port)
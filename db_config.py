@@ -0,0 +1,45 @@
+"""Параметры подключения к БД из SUPABASE_DB_URL
+
+Отдельный модуль без побочных эффектов: его импортирует и бот, и
+python migrations.py, которому не нужны токен бота, логирование и
+остальная инициализация bot_with_supabase.py.
+"""
+import os
+
+
+def parse_db_url(url):
+    """Разбираем URL подключения"""
+    url = url.replace('postgresql://', '')
+    
+    if '@' in url:
+        auth, rest = url.split('@', 1)
+        user, password = auth.split(':', 1)
+    else:
+        user, password = 'postgres', ''
+        rest = url
+    
+    if ':' in rest:
+        host_port, database = rest.split('/', 1)
+        if ':' in host_port:
+            host, port = host_port.split(':', 1)
+            port = int(port)
+        else:
+            host, port = host_port, 5432
+    else:
+        host, port = rest, 5432
+        database = 'postgres'
+    
+    database = database.split('?')[0]
+    
+    return {
+        'user': user,
+        'password': password,
+        'host': host,
+        'port': port,
+        'database': database
+    }
+
+
+def db_params():
+    """Параметры pg8000.native.Connection из переменной окружения SUPABASE_DB_URL"""
+    return parse_db_url(os.environ['SUPABASE_DB_URL'])
@@ -0,0 +1,297 @@
+"""Версионированные миграции схемы БД бота
+
+Запуск: python migrations.py migrate|status|check
+
+- migrate - применить недостающие миграции (бот делает это и сам при
+  запуске, см. DB_MIGRATE_ON_START в bot_with_supabase.py);
+- status - какие миграции применены, а какие ждут;
+- check - EXPLAIN горячих запросов бота: предупреждает о запросах,
+  которые читают таблицу целиком (Seq Scan), потому что нет индекса.
+
+Применённые версии хранятся в таблице schema_migrations. Каждая миграция
+выполняется в своей транзакции, а параллельные запуски (несколько
+экземпляров бота) ждут друг друга на advisory-блокировке. Первые
+миграции написаны через IF NOT EXISTS: базы, созданные до появления
+миграций вручную, проходят их без ошибок.
+"""
+import sys
+from collections import namedtuple
+
+Migration = namedtuple('Migration', 'version name statements')
+
+# Ключ pg_advisory_lock, под которым применяются миграции
+MIGRATION_LOCK_KEY = 7240917
+
+MIGRATIONS = [
+    Migration(1, 'base schema', [
+        """
+        CREATE TABLE IF NOT EXISTS warehouses (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            id SERIAL PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            username TEXT,
+            full_name TEXT,
+            role TEXT NOT NULL DEFAULT 'user',
+            warehouse_id INTEGER REFERENCES warehouses(id),
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS stock (
+            id SERIAL PRIMARY KEY,
+            warehouse_id INTEGER NOT NULL REFERENCES warehouses(id),
+            product_id INTEGER NOT NULL REFERENCES products(id),
+            quantity NUMERIC NOT NULL DEFAULT 0,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id SERIAL PRIMARY KEY,
+            product_id INTEGER NOT NULL REFERENCES products(id),
+            warehouse_id INTEGER NOT NULL REFERENCES warehouses(id),
+            type TEXT NOT NULL,
+            quantity NUMERIC NOT NULL,
+            date TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            notes TEXT
+        )
+        """,
+        # ON CONFLICT в upsert'ах бота требует этих уникальных индексов
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_telegram_id_key ON users (telegram_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS stock_warehouse_id_product_id_key ON stock (warehouse_id, product_id)",
+    ]),
+    Migration(2, 'transactions.user_id', [
+        # Автора старых операций можно восстановить только для складов,
+        # за которыми закреплен ровно один пользователь
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_name = 'transactions' AND column_name = 'user_id'
+            ) THEN
+                ALTER TABLE transactions
+                    ADD COLUMN user_id INTEGER REFERENCES users(id) ON DELETE SET NULL;
+                UPDATE transactions t
+                SET user_id = single.user_id
+                FROM (
+                    SELECT warehouse_id, MIN(id) AS user_id
+                    FROM users
+                    WHERE warehouse_id IS NOT NULL
+                    GROUP BY warehouse_id
+                    HAVING COUNT(*) = 1
+                ) single
+                WHERE t.warehouse_id = single.warehouse_id;
+            END IF;
+        END
+        $$
+        """,
+    ]),
+    Migration(3, 'daily transaction rollup', [
+        """
+        CREATE TABLE IF NOT EXISTS transaction_daily_rollup (
+            day DATE NOT NULL,
+            warehouse_id INTEGER NOT NULL REFERENCES warehouses(id) ON DELETE CASCADE,
+            product_id INTEGER NOT NULL REFERENCES products(id) ON DELETE CASCADE,
+            type TEXT NOT NULL,
+            quantity NUMERIC NOT NULL DEFAULT 0,
+            operations INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, warehouse_id, product_id, type)
+        )
+        """,
+        # Заполняем по журналу, только если сводка еще пустая
+        """
+        INSERT INTO transaction_daily_rollup (day, warehouse_id, product_id, type, quantity, operations)
+        SELECT date::date, warehouse_id, product_id, type, SUM(quantity), COUNT(*)
+        FROM transactions
+        WHERE NOT EXISTS (SELECT 1 FROM transaction_daily_rollup)
+        GROUP BY date::date, warehouse_id, product_id, type
+        """,
+    ]),
+    Migration(4, 'indexes for hot queries', [
+        "CREATE INDEX IF NOT EXISTS users_warehouse_id_idx ON users (warehouse_id)",
+        "CREATE INDEX IF NOT EXISTS transactions_date_idx ON transactions (date)",
+        "CREATE INDEX IF NOT EXISTS transactions_product_id_idx ON transactions (product_id)",
+        # Проверка дубликатов в process_add_product: WHERE LOWER(name) = LOWER(:name)
+        "CREATE INDEX IF NOT EXISTS products_lower_name_idx ON products (LOWER(name))",
+    ]),
+    # stock стала разреженной (нет строки - остаток 0): убираем нулевые строки,
+    # которые раньше создавались для каждой пары склад x товар
+    Migration(5, 'sparse stock', [
+        "DELETE FROM stock WHERE quantity = 0",
+    ]),
+]
+
+# Горячие запросы бота (копии из bot_with_supabase.py) с примерными параметрами
+HOT_QUERIES = [
+    ('user by telegram_id', """
+        SELECT u.id, u.telegram_id, u.username, u.full_name, u.role,
+               u.warehouse_id, w.name as warehouse_name
+        FROM users u
+        LEFT JOIN warehouses w ON u.warehouse_id = w.id
+        WHERE u.telegram_id = :telegram_id
+    """, {'telegram_id': 0}),
+    ('stock of warehouse product', """
+        SELECT quantity FROM stock
+        WHERE product_id = :product_id AND warehouse_id = :warehouse_id
+    """, {'product_id': 0, 'warehouse_id': 0}),
+    ('stock of warehouse', """
+        SELECT s.product_id, s.quantity FROM stock s
+        WHERE s.warehouse_id = :warehouse_id AND s.quantity > 0
+    """, {'warehouse_id': 0}),
+    ('stock out', """
+        UPDATE stock
+        SET quantity = quantity - :quantity, updated_at = NOW()
+        WHERE warehouse_id = :warehouse_id AND product_id = :product_id
+          AND quantity >= :quantity
+    """, {'quantity': 1, 'warehouse_id': 0, 'product_id': 0}),
+    ('product name duplicate check', """
+        SELECT id, name FROM products
+        WHERE LOWER(name) = LOWER(:product_name)
+    """, {'product_name': ''}),
+    ('users of warehouse', """
+        SELECT u.full_name FROM users u WHERE u.warehouse_id = :warehouse_id
+    """, {'warehouse_id': 0}),
+    ('transactions export period', """
+        SELECT t.date, t.quantity FROM transactions t
+        WHERE t.date >= :start_date
+        ORDER BY t.date DESC
+    """, {'start_date': '2100-01-01'}),
+    ('transactions of product', """
+        SELECT COUNT(*) FROM transactions WHERE product_id = :id
+    """, {'id': 0}),
+    ('period totals', """
+        SELECT product_id, SUM(quantity) FROM transaction_daily_rollup
+        WHERE day >= :start_date
+        GROUP BY product_id
+    """, {'start_date': '2100-01-01'}),
+]
+
+
+def ensure_migrations_table(conn):
+    conn.run("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+    """)
+
+
+def applied_versions(conn):
+    """{версия: (название, когда применена)}"""
+    ensure_migrations_table(conn)
+    rows = conn.run("SELECT version, name, applied_at FROM schema_migrations")
+    return {version: (name, applied_at) for version, name, applied_at in rows}
+
+
+def pending_migrations(conn):
+    applied = applied_versions(conn)
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def migrate(conn, log=print):
+    """Применить недостающие миграции по порядку. Возвращает список примененных версий"""
+    conn.run("SELECT pg_advisory_lock(:key)", key=MIGRATION_LOCK_KEY)
+    try:
+        done = []
+        # Список перечитываем под блокировкой: другой экземпляр мог успеть раньше
+        for migration in pending_migrations(conn):
+            conn.run("START TRANSACTION")
+            try:
+                for statement in migration.statements:
+                    conn.run(statement)
+                conn.run("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)",
+                         version=migration.version, name=migration.name)
+                conn.run("COMMIT")
+            except Exception:
+                conn.run("ROLLBACK")
+                raise
+            log(f"✅ Migration {migration.version} applied: {migration.name}")
+            done.append(migration.version)
+        return done
+    finally:
+        conn.run("SELECT pg_advisory_unlock(:key)", key=MIGRATION_LOCK_KEY)
+
+
+def seq_scans(plan):
+    """Таблицы, которые узел плана (и его потомки) читает через Seq Scan"""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        found.extend(seq_scans(child))
+    return found
+
+
+def check(conn, log=print):
+    """EXPLAIN горячих запросов; возвращает [(запрос, [таблицы с Seq Scan])]
+
+    Seq Scan запрещается (enable_seqscan = off): на маленьких таблицах
+    планировщик и так выбирает полный просмотр, а интересно, может ли он
+    вообще обойтись без него. Если Seq Scan остался - подходящего индекса нет.
+    """
+    problems = []
+    for name, sql, params in HOT_QUERIES:
+        conn.run("START TRANSACTION")
+        try:
+            conn.run("SET LOCAL enable_seqscan = off")
+            plan = conn.run(f"EXPLAIN (FORMAT JSON) {sql}", **params)[0][0][0]['Plan']
+        finally:
+            conn.run("ROLLBACK")
+        tables = seq_scans(plan)
+        if tables:
+            problems.append((name, tables))
+            log(f"⚠️ {name}: Seq Scan on {', '.join(tables)}")
+        else:
+            log(f"✅ {name}: {plan['Node Type']}")
+    return problems
+
+
+def main(argv):
+    command = argv[1] if len(argv) > 1 else 'status'
+    if command not in ('migrate', 'status', 'check'):
+        print(__doc__)
+        return 2
+
+    # Та же переменная окружения SUPABASE_DB_URL, что и у бота
+    from pg8000.native import Connection
+    from db_config import db_params
+
+    conn = Connection(**db_params())
+    try:
+        if command == 'migrate':
+            done = migrate(conn)
+            print(f"Применено миграций: {len(done)}")
+        elif command == 'status':
+            applied = applied_versions(conn)
+            for migration in MIGRATIONS:
+                if migration.version in applied:
+                    print(f"✅ {migration.version} {migration.name} ({applied[migration.version][1]:%d.%m.%Y %H:%M})")
+                else:
+                    print(f"⏳ {migration.version} {migration.name} - не применена")
+        else:
+            # Горячие запросы рассчитаны на актуальную схему: без нее EXPLAIN
+            # покажет ложные Seq Scan или упадет на отсутствующей таблице
+            if pending_migrations(conn):
+                print("⚠️ Есть неприменённые миграции - сначала migrate")
+                return 1
+            return 1 if check(conn) else 0
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,117 @@
+"""Разбор файла массового пополнения остатков (.xlsx или .csv)
+
+Каждая строка файла - одно пополнение: склад, товар, количество (в этом
+порядке колонок). Склад и товар задаются названием (без учета регистра)
+или ID. Первая строка пропускается, если это заголовок (количество в ней
+не число), пустые строки игнорируются.
+
+Разбор не ходит в БД: названия сверяются со справочниками, переданными
+вызывающим кодом, а все ошибки собираются в список отклоненных строк,
+чтобы сообщить о них одним ответом.
+"""
+import csv
+import io
+from decimal import Decimal, InvalidOperation
+
+from openpyxl import load_workbook
+
+EXTENSIONS = ('.xlsx', '.csv')
+
+
+def parse_quantity(value):
+    """Количество из ячейки ("2,5", 2.5, "3") -> Decimal или None"""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        value = repr(value)
+    try:
+        quantity = Decimal(str(value).strip().replace(',', '.'))
+    except InvalidOperation:
+        return None
+    return quantity if quantity.is_finite() else None
+
+
+def read_xlsx(data):
+    """Строки первого листа книги"""
+    workbook = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for row in workbook.worksheets[0].iter_rows(values_only=True):
+            yield row
+    finally:
+        workbook.close()
+
+
+def read_csv(data):
+    """Строки CSV; разделитель (";" из русского Excel или ",") определяется сам
+
+    Кодировка - UTF-8, а если файл в ней не читается - cp1251, в которой
+    сохраняет CSV русский Excel.
+    """
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        text = data.decode('cp1251')
+    try:
+        dialect = csv.Sniffer().sniff(text[:4096], delimiters=';,\t')
+    except csv.Error:
+        dialect = csv.excel
+    yield from csv.reader(io.StringIO(text), dialect)
+
+
+def read_rows(data, filename):
+    """Строки файла по расширению имени; ValueError для других форматов"""
+    name = (filename or '').lower()
+    if name.endswith('.xlsx'):
+        return read_xlsx(data)
+    if name.endswith('.csv'):
+        return read_csv(data)
+    raise ValueError(f"Поддерживаются файлы {', '.join(EXTENSIONS)}")
+
+
+def resolve(value, ids, names):
+    """ID справочника по ячейке: число - ID, иначе название. None - не найдено"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)) and int(value) == value:
+        value = int(value)
+        return value if value in names else None
+    text = str(value).strip()
+    if text.isdigit() and int(text) in names:
+        return int(text)
+    return ids.get(text.lower())
+
+
+def parse_movements(rows, warehouse_ids, warehouse_names, product_ids, product_names):
+    """Проверить строки файла по справочникам
+
+    warehouse_ids/product_ids - название в нижнем регистре -> ID,
+    warehouse_names/product_names - ID -> название (как в Catalog).
+    Возвращает (принятые [(номер строки, склад, товар, количество)],
+    отклоненные [(номер строки, причина)]).
+    """
+    accepted = []
+    rejected = []
+    for line, row in enumerate(rows, start=1):
+        cells = list(row or ())[:3]
+        cells += [None] * (3 - len(cells))
+        if all(cell is None or str(cell).strip() == '' for cell in cells):
+            continue
+
+        warehouse, product, quantity_cell = cells
+        quantity = parse_quantity(quantity_cell)
+        if quantity is None and line == 1:
+            continue  # заголовок
+
+        warehouse_id = resolve(warehouse, warehouse_ids, warehouse_names)
+        product_id = resolve(product, product_ids, product_names)
+        if warehouse_id is None:
+            rejected.append((line, f"склад '{warehouse}' не найден"))
+        elif product_id is None:
+            rejected.append((line, f"товар '{product}' не найден"))
+        elif quantity is None:
+            rejected.append((line, f"количество '{quantity_cell}' не число"))
+        elif quantity <= 0:
+            rejected.append((line, "количество должно быть больше нуля"))
+        else:
+            accepted.append((line, warehouse_id, product_id, quantity))
+    return accepted, rejected
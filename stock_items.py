@@ -0,0 +1,45 @@
+"""Разбор списка позиций "товар:количество" из сообщения (/spend, /add)
+
+Товар задается ID или началом названия (может содержать пробелы), пары
+разделяются пробелами, запятыми или точкой с запятой. Запятая в
+количестве - десятичная ("3:2,5" - 2,5 л), но только если за дробной
+частью не начинается следующая пара: "3:2,7:1" - это 3:2 и 7:1, а
+"3:2,12:5" - 3:2 и 12:5.
+
+Сообщение должно целиком состоять из пар: все остальное возвращается
+как непонятные куски, и вызывающий отклоняет сообщение целиком.
+"""
+import re
+from decimal import Decimal
+
+# Дробная часть не может откатиться на меньшее число цифр ((?!\d)):
+# иначе в "3:2,12:5" она забрала бы первую цифру следующего ID
+SPEND_ITEM_RE = re.compile(r'([^:,;\n]+?)\s*:\s*(\d+(?:[.,]\d+(?!\d)(?!\s*:))?)')
+SEPARATORS_RE = re.compile(r'[\s,;]+')
+
+
+def ambiguous_label(label):
+    """Название из нескольких слов, где есть число или @склад ("7 8", "мерло 2")
+
+    Скорее всего это пропущенное двоеточие у соседней пары, а не товар -
+    такое название могло бы совпасть с другим товаром по началу.
+    """
+    words = label.split()
+    return len(words) > 1 and any(word.isdigit() or word.startswith('@') for word in words)
+
+
+def parse_spend_items(text):
+    """Разобрать "3:5 7:2,5 мерло:1" -> ([(товар, Decimal)], [непонятные куски])"""
+    items = []
+    junk = []
+    position = 0
+    for match in SPEND_ITEM_RE.finditer(text):
+        junk += [piece for piece in SEPARATORS_RE.split(text[position:match.start()]) if piece]
+        position = match.end()
+        label, quantity = match.group(1).strip(), match.group(2)
+        if ambiguous_label(label):
+            junk.append(label)
+        else:
+            items.append((label, Decimal(quantity.replace(',', '.'))))
+    junk += [piece for piece in SEPARATORS_RE.split(text[position:]) if piece]
+    return items, junk
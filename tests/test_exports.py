@@ -0,0 +1,40 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+import pytest
+
+import exports
+
+
+def transaction(i, quantity):
+    date = datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i)
+    return (date, 'Пользователь', 'Склад', 'Вино', 'Расход', quantity, None)
+
+
+@pytest.mark.skipif(not exports.PARQUET_AVAILABLE, reason='нужен pyarrow')
+def test_parquet_accepts_new_scale_in_later_batch():
+    import pyarrow.parquet as pq
+
+    rows = [transaction(i, Decimal('5')) for i in range(exports.EXPORT_FETCH_SIZE)]
+    rows.append(transaction(len(rows), Decimal('2.125')))
+    rows.append(transaction(len(rows), Decimal('123456.0000000001')))
+
+    output, count = exports.write_transactions(iter(rows), 'parquet')
+
+    assert count == len(rows)
+    table = pq.read_table(output)
+    quantities = table.column('Количество').to_pylist()
+    assert quantities[0] == Decimal('5')
+    assert quantities[-2] == Decimal('2.125')
+    assert quantities[-1] == Decimal('123456.000000000')
+
+
+@pytest.mark.skipif(not exports.PARQUET_AVAILABLE, reason='нужен pyarrow')
+def test_parquet_keeps_empty_notes_as_strings():
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = [transaction(i, 1) for i in range(3)]
+    output, _ = exports.write_transactions(iter(rows), 'parquet')
+
+    assert pq.read_table(output).schema.field('Примечания').type == pa.string()
@@ -0,0 +1,30 @@
+from decimal import Decimal
+
+import stock_import
+
+
+def test_read_csv_falls_back_to_cp1251():
+    data = 'Склад;Товар;Количество\r\nБар;Мерло;2,5\r\n'.encode('cp1251')
+
+    assert list(stock_import.read_csv(data)) == [
+        ['Склад', 'Товар', 'Количество'],
+        ['Бар', 'Мерло', '2,5'],
+    ]
+
+
+def test_read_csv_utf8_with_bom():
+    data = '\ufeffСклад,Товар,Количество\nБар,Мерло,3\n'.encode('utf-8')
+
+    assert list(stock_import.read_csv(data))[1] == ['Бар', 'Мерло', '3']
+
+
+def test_parse_movements_from_cp1251_csv():
+    data = 'Склад;Товар;Количество\r\nБар;Мерло;2,5\r\nБар;Рислинг;1\r\n'.encode('cp1251')
+
+    accepted, rejected = stock_import.parse_movements(
+        stock_import.read_rows(data, 'приход.csv'),
+        {'бар': 1}, {1: 'Бар'}, {'мерло': 7}, {7: 'Мерло'},
+    )
+
+    assert accepted == [(2, 1, 7, Decimal('2.5'))]
+    assert rejected == [(3, "товар 'Рислинг' не найден")]
@@ -0,0 +1,37 @@
+from decimal import Decimal
+
+import pytest
+
+from stock_items import parse_spend_items
+
+
+@pytest.mark.parametrize('text, items', [
+    ('3:2,7:1', [('3', Decimal('2')), ('7', Decimal('1'))]),
+    ('3:2,12:5', [('3', Decimal('2')), ('12', Decimal('5'))]),
+    ('3:2,75:1', [('3', Decimal('2')), ('75', Decimal('1'))]),
+    ('3:2,5,7:1', [('3', Decimal('2.5')), ('7', Decimal('1'))]),
+    ('3:2, 7:1', [('3', Decimal('2')), ('7', Decimal('1'))]),
+    ('3:2,5', [('3', Decimal('2.5'))]),
+    ('3:2.5,7:1', [('3', Decimal('2.5')), ('7', Decimal('1'))]),
+    ('3:2,5 мерло:1', [('3', Decimal('2.5')), ('мерло', Decimal('1'))]),
+    ('красное сухое : 3', [('красное сухое', Decimal('3'))]),
+])
+def test_parse_spend_items(text, items):
+    assert parse_spend_items(text) == (items, [])
+
+
+def test_parse_spend_items_reports_junk():
+    items, junk = parse_spend_items('3:2 7 мерло')
+
+    assert items == [('3', Decimal('2'))]
+    assert junk == ['7', 'мерло']
+
+
+@pytest.mark.parametrize('text, junk', [
+    ('3:5 7 8:1', ['7 8']),
+    ('3:5 мерло 2:1', ['мерло 2']),
+    ('@2 3:5', ['@2 3']),
+    ('3:abc 7:1', ['3:', 'abc 7']),
+])
+def test_parse_spend_items_does_not_merge_leftovers_into_labels(text, junk):
+    assert parse_spend_items(text)[1] == junk